@@ -0,0 +1,123 @@
+"""
+rotation of FESOM velocities from the rotated model grid to geographical east/north components
+
+For a fixed mesh the rotation is linear in (u, v) at every element:
+
+    u_geo = uu * u + uv * v
+    v_geo = vu * u + vv * v
+
+The four coefficients are computed once per mesh from the element centers of `elem_grid`
+(and cached on disk), the rotation itself is then two multiply-adds per value. On dask
+arrays it is applied chunk by chunk, so rotated velocities of all levels can be written to
+zarr without holding more than a few chunks in memory.
+
+    rot = UVRotation.cached(run.elem_grid.to_dask(), cachedir)
+    u_geo, v_geo = rot(data.u, data.v)
+"""
+import os
+import hashlib
+
+import numpy as np
+import xarray as xr
+
+# Euler angles (alpha, beta, gamma) of the rotated FESOM grid
+EULER_ANGLES = (50, 15, -90)
+
+
+def euler_matrix(al, be, ga):
+    """
+    rotation from geographical to rotated Cartesian coordinates, angles in degrees
+    """
+    al, be, ga = np.deg2rad([al, be, ga])
+    return np.array([
+        [np.cos(ga) * np.cos(al) - np.sin(ga) * np.cos(be) * np.sin(al),
+         np.cos(ga) * np.sin(al) + np.sin(ga) * np.cos(be) * np.cos(al),
+         np.sin(ga) * np.sin(be)],
+        [-np.sin(ga) * np.cos(al) - np.cos(ga) * np.cos(be) * np.sin(al),
+         -np.sin(ga) * np.sin(al) + np.cos(ga) * np.cos(be) * np.cos(al),
+         np.cos(ga) * np.sin(be)],
+        [np.sin(be) * np.sin(al),
+         -np.sin(be) * np.cos(al),
+         np.cos(be)],
+    ])
+
+
+def east_north(lon, lat):
+    """
+    Cartesian unit vectors pointing east and north at lon, lat (radians), shape (3, n)
+    """
+    east = np.stack([-np.sin(lon), np.cos(lon), np.zeros_like(lon)])
+    north = np.stack([-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)])
+    return east, north
+
+
+def rotation_coefficients(lon, lat, angles=EULER_ANGLES):
+    """
+    (uu, uv, vu, vv) of the elements at geographical lon, lat (degrees), as in `vec_rotate_r2g(..., flag=1)`
+    """
+    matrix = euler_matrix(*angles)
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    xyz = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    x, y, z = matrix @ xyz
+    rlon, rlat = np.arctan2(y, x), np.arcsin(np.clip(z, -1, 1))
+
+    # unit vectors of the rotated grid, expressed in geographical Cartesian coordinates
+    # (the inverse of the orthogonal Euler matrix is its transpose)
+    reast, rnorth = (matrix.T @ e for e in east_north(rlon, rlat))
+    east, north = east_north(lon, lat)
+    return (np.sum(east * reast, axis=0), np.sum(east * rnorth, axis=0),
+            np.sum(north * reast, axis=0), np.sum(north * rnorth, axis=0))
+
+
+class UVRotation:
+    def __init__(self, uu, uv, vu, vv, dim="elem"):
+        self.dim = dim
+        self.coefficients = [xr.DataArray(np.asarray(c, "f4"), dims=[dim]) for c in (uu, uv, vu, vv)]
+
+    @classmethod
+    def from_grid(cls, grid, angles=EULER_ANGLES, dim="elem"):
+        """
+        :param grid: FESOM elem_grid with grid_center_lon/lat of every element
+        """
+        return cls(*rotation_coefficients(grid.grid_center_lon.values, grid.grid_center_lat.values, angles), dim=dim)
+
+    @classmethod
+    def cached(cls, grid, cachedir, angles=EULER_ANGLES, dim="elem"):
+        """
+        coefficients of the mesh are stored in `cachedir`. The file name contains a hash of the element
+        centers, so meshes of the same size never share coefficients
+        """
+        lon, lat = grid.grid_center_lon.values, grid.grid_center_lat.values
+        h = hashlib.blake2b(digest_size=8)
+        for a in (lon, lat):
+            h.update(np.ascontiguousarray(a, "f8").tobytes())
+        fname = os.path.join(cachedir, "uv_rotation_{}_{}_{}.npz".format(
+            grid.sizes["grid_size"], "_".join(f"{a:g}" for a in angles), h.hexdigest()))
+        if os.path.isfile(fname):
+            cache = np.load(fname)
+            return cls(*(cache[c] for c in ("uu", "uv", "vu", "vv")), dim=dim)
+        rotation = cls(*rotation_coefficients(lon, lat, angles), dim=dim)
+        os.makedirs(cachedir, exist_ok=True)
+        with open(fname + ".tmp", "wb") as f:
+            np.savez(f, **{c: coef.values for c, coef in zip(("uu", "uv", "vu", "vv"), rotation.coefficients)})
+        os.replace(fname + ".tmp", fname)
+        return rotation
+
+    def __call__(self, u, v):
+        """
+        geographical (u, v) from model (u, v) with `dim` as one of their dimensions, lazy for dask arrays
+        """
+        uu, uv, vu, vv = self.coefficients
+        if u.chunks is not None:
+            chunks = dict(zip(u.dims, u.chunks))[self.dim]
+            uu, uv, vu, vv = (c.chunk({self.dim: chunks}) for c in self.coefficients)
+        u_geo = (uu * u + uv * v).astype(u.dtype).assign_attrs(u.attrs)
+        v_geo = (vu * u + vv * v).astype(v.dtype).assign_attrs(v.attrs)
+        return u_geo.transpose(*u.dims), v_geo.transpose(*v.dims)
+
+    def to_zarr(self, data, store, u="u", v="v", **kwargs):
+        """
+        write rotated `u` and `v` of `data` to a zarr store, both are computed from the same chunks of data
+        """
+        u_geo, v_geo = self(data[u], data[v])
+        return xr.Dataset({u: u_geo, v: v_geo}).to_zarr(store, **kwargs)
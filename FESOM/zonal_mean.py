@@ -0,0 +1,75 @@
+"""
+latitude (or longitude) band means on unstructured grids (FESOM nodes, ICON cells, IFS grid points)
+
+The band of every grid point and its area weight are computed once per grid. Applying the
+operator to a (..., point) array is then a sparse matrix product, the weighted equivalent
+of a bincount per band, which works chunk by chunk on dask arrays. A year of zonal means
+is computed as a (time, band) time series without loading the full fields at once.
+
+    zm = BandMean(grid.grid_center_lat.values, weights=grid.cell_area.values, bins=180)
+    zonal = zm(data[["sst", "ssh"]], dim="nod2").compute()
+"""
+import numpy as np
+import xarray as xr
+import scipy.sparse
+
+
+class BandMean:
+    def __init__(self, coord, bins=180, range=(-90, 90), weights=None, mask=None, name="lat"):
+        """
+        :param coord: latitude (or longitude) of every grid point
+        :param bins: number of bands in `range` or band edges, bands are closed on the left like in np.histogram
+        :param weights: area of every grid point, equal weights if None
+        :param mask: grid points to use, e.g. ocean or a region, all if None
+        :param name: name of the band dimension of the results
+        """
+        coord = np.asarray(coord)
+        self.edges = np.linspace(*range, bins + 1) if np.isscalar(bins) else np.asarray(bins, "f8")
+        nbands = len(self.edges) - 1
+        band = np.searchsorted(self.edges, coord, side="right") - 1
+        band[coord == self.edges[-1]] = nbands - 1
+        use = (band >= 0) & (band < nbands)
+        if mask is not None:
+            use &= np.asarray(mask, bool)
+        weights = np.ones(len(coord)) if weights is None else np.asarray(weights, "f8")
+        points = np.flatnonzero(use)
+        # (point, band) so that (..., point) @ matrix sums every band
+        self.matrix = scipy.sparse.csr_matrix((weights[points], (points, band[points])),
+                                              shape=(len(coord), nbands))
+        self.weight = np.asarray(self.matrix.sum(axis=0)).ravel()
+        self.name = name
+        self.bands = 0.5 * (self.edges[1:] + self.edges[:-1])
+
+    def apply(self, values, skipna=True):
+        """
+        band means of a numpy array (..., point)
+        """
+        values = np.asarray(values)
+        shape = values.shape[:-1]
+        values = values.reshape(-1, values.shape[-1])
+        if skipna:
+            valid = np.isfinite(values)
+            sums = (self.matrix.T @ np.where(valid, values, 0).T).T
+            weight = (self.matrix.T @ valid.T.astype("f8")).T
+        else:
+            sums = (self.matrix.T @ values.T).T
+            weight = self.weight
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(weight > 0, sums / weight, np.nan)
+        return means.reshape(shape + (len(self.bands),))
+
+    def __call__(self, data, dim, skipna=True):
+        """
+        band means of a DataArray or of all variables of a Dataset along `dim`, lazily for dask arrays
+
+        `dim` has to be a single chunk, other dimensions may be chunked freely
+        """
+        if isinstance(data, xr.Dataset):
+            return xr.Dataset({name: self(var, dim, skipna) for name, var in data.data_vars.items() if dim in var.dims})
+        if data.chunks is not None:
+            data = data.chunk({dim: -1})
+        out = xr.apply_ufunc(self.apply, data, kwargs={"skipna": skipna},
+                             input_core_dims=[[dim]], output_core_dims=[[self.name]],
+                             dask="parallelized", output_dtypes=["f8"],
+                             dask_gufunc_kwargs={"output_sizes": {self.name: len(self.bands)}})
+        return out.assign_coords({self.name: self.bands}).assign_attrs(data.attrs)
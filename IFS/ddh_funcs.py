@@ -1,9 +1,19 @@
-from itertools import islice
+import os
+import re
+import json
+import shutil
+import hashlib
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
+import tqdm
+import zarr
 import numpy as np
 import xarray as xr
 import pandas as pd
 
+from tracing import span
+
 VARDEFS = {
     "atmflx": {
         "T  FSWR": ("sw", {"units": "W/m2","long_name": "T flux: SW rad"}),
@@ -110,18 +120,61 @@ def round_to_the_interval(times):
     ref = np.datetime64("2020-01-01")
     return ref + np.round((times - ref) / np.timedelta64(450, "s")) * np.timedelta64(450, "s")
 
-def load_ddh(filename, kind):
-    with open(filename) as ifh:
-        header = dict(zip(*map(str.split, islice(ifh, 2))))
+def fwf_colspecs(rows):
+    # same column detection as pd.read_fwf: runs of columns which are not blank in any row
+    mask = np.zeros(max(map(len, rows)) + 1, dtype=int)
+    for row in rows:
+        for m in re.finditer(r"[^\s]+", row.decode()):
+            mask[m.start():m.end()] = 1
+    edges = np.flatnonzero(np.diff(mask, prepend=0) != 0)
+    return list(zip(edges[::2], edges[1::2]))
+
+def read_ddh(filename, infer_nrows=100):
+    """
+    header and columns of a DDH text file
+
+    the fixed-width table is read as one block of bytes and every column is
+    converted to numbers at once instead of line by line
+    """
+    with span("read_ddh", filename=os.path.basename(filename)) as sp, open(filename, "rb") as ifh:
+        data = ifh.read()
+        sp.add(bytes_read=len(data))
+    lines = data.split(b"\n", 3)
+    header = dict(zip(*(line.decode().split() for line in lines[:2])))
     header = {k:f(header[k]) for k, f in HEADER_TYPES.items() if k in header}
-    
-    df = pd.read_fwf(filename, header=0, skiprows=2, parse_dates=["vdat"])
-    ds = (df.to_xarray()
-          .assign(time = lambda ds: ds.vdat + ds.vtim * np.timedelta64(60*60, "s"))
-          .drop_vars(["#   idat", "itim", "vdat", "vtim", "index"]))
-    
-    times, tidx = np.unique(ds.time, return_inverse=True)
-    levels, lidx = np.unique(ds.lev, return_inverse=True)
+
+    names = lines[2]
+    rows = lines[3].rstrip(b"\n").split(b"\n")
+    colspecs = fwf_colspecs([names] + rows[:infer_nrows - 1])
+    # rows padded with null bytes to the longest row, one byte per column
+    table = np.array(rows)
+    table = table.view("S1").reshape(len(rows), table.itemsize)
+
+    columns = {}
+    with span("parse_ddh", filename=os.path.basename(filename)) as sp:
+        for a, b in colspecs:
+            b = min(b, table.shape[1])
+            field = np.ascontiguousarray(table[:, a:b]).view(f"S{b - a}").ravel()
+            try:
+                values = field.astype("f8")
+            except ValueError:  # blank fields
+                values = pd.to_numeric(np.char.strip(field).astype(str), errors="coerce")
+            columns[names[a:b].strip().decode()] = values
+        sp.add(elements=len(rows) * len(colspecs))
+    return header, columns
+
+def ddh_arrays(filename, kind):
+    """
+    header, times, levels and the (time, level) arrays of the VARDEFS[kind] variables of a DDH file
+    """
+    header, columns = read_ddh(filename)
+    vdat = columns["vdat"].astype("i8")
+    days, didx = np.unique(vdat, return_inverse=True)
+    days = pd.to_datetime(days.astype(str), format="%Y%m%d").values
+    time = days[didx] + columns["vtim"] * np.timedelta64(60*60, "s")
+
+    times, tidx = np.unique(time, return_inverse=True)
+    levels, lidx = np.unique(columns["lev"].astype("i8"), return_inverse=True)
 
     if header["west"]>180: header["west"]=header["west"]-360.
     if header["exp"]=='hr2n': # interval is 7.5mins for 9km run with expid hr2n
@@ -132,9 +185,96 @@ def load_ddh(filename, kind):
     def reshape_var(var):
         out = np.full((len(times), len(levels)), np.nan, dtype=var.dtype)
         out[tidx, lidx] = var
-        return xr.DataArray(out, dims=("time", "level"))
+        return out
+    arrays = {newname: reshape_var(columns[oldname]) for oldname, (newname, attrs) in VARDEFS[kind].items()}
+    return header, rounded, levels, arrays
+
+# cache of ddh_arrays: one directory per (source file, kind) holding the header and the
+# source size and mtime in meta.json, and every array as .npy which is memory-mapped on load.
+# A changed source file no longer matches meta.json and is parsed again. The cache directories
+# are kept in `cachedir` or $DDH_CACHE, next to the source files only if neither is set.
+CACHE_VERSION = 1
+
+def ddh_cache_path(filename, kind, cachedir=None):
+    """
+    in `cachedir`, $DDH_CACHE if not given, or next to the source file if neither is set
+    """
+    cachedir = cachedir or os.environ.get("DDH_CACHE")
+    if not cachedir:
+        return f"{filename}.{kind}.ddhcache"
+    key = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=8).hexdigest()
+    return os.path.join(cachedir, f"{os.path.basename(filename)}.{key}.{kind}.ddhcache")
+
+def _source_key(filename, kind):
+    stat = os.stat(filename)
+    return {"path": os.path.abspath(filename), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "kind": kind, "version": CACHE_VERSION}
+
+def _read_cache(path, key):
+    try:
+        with open(os.path.join(path, "meta.json")) as infile:
+            meta = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if meta["key"] != key:
+        return None
+    load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    with span("read_ddh_cache") as sp:
+        arrays = {name: load(name) for name in meta["variables"]}
+        sp.add(bytes_read=sum(a.nbytes for a in arrays.values()))
+    return meta["header"], load("time"), load("level"), arrays
+
+def _write_cache(path, key, header, rounded, levels, arrays):
+    tmp = f"{path}.tmp{os.getpid()}"
+    try:
+        os.makedirs(tmp, exist_ok=True)
+        with span("write_ddh_cache") as sp:
+            np.save(os.path.join(tmp, "time.npy"), rounded)
+            np.save(os.path.join(tmp, "level.npy"), levels)
+            for name, values in arrays.items():
+                np.save(os.path.join(tmp, f"{name}.npy"), values)
+            sp.add(bytes_written=sum(a.nbytes for a in arrays.values()))
+        # meta.json last, a cache without it is never used
+        with open(os.path.join(tmp, "meta.json"), "w") as outfile:
+            json.dump({"key": key, "header": header, "variables": list(arrays)}, outfile)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def cached_ddh_arrays(filename, kind, cachedir=None):
+    """
+    ddh_arrays from the cache in `ddh_cache_path`, the arrays are read-only memory maps
+
+    the cache is written on the first load, if it can't be written the file is just parsed
+    """
+    path = ddh_cache_path(filename, kind, cachedir)
+    key = _source_key(filename, kind)
+    cached = _read_cache(path, key)
+    if cached is not None:
+        return cached
+    header, rounded, levels, arrays = ddh_arrays(filename, kind)
+    try:
+        _write_cache(path, key, header, rounded, levels, arrays)
+    except OSError as e:
+        warnings.warn(f"could not write DDH cache {path}: {e}")
+    return header, rounded, levels, arrays
+
+def load_ddh(filename, kind, cache=None, cachedir=None):
+    """
+    :param cache: keep the parsed arrays in `ddh_cache_path`, by default only if `cachedir`
+        or $DDH_CACHE is set, so nothing is written next to the source files unless asked for
+    """
+    if cache is None:
+        cache = bool(cachedir or os.environ.get("DDH_CACHE"))
+    if cache:
+        header, rounded, levels, arrays = cached_ddh_arrays(filename, kind, cachedir)
+    else:
+        header, rounded, levels, arrays = ddh_arrays(filename, kind)
     ds = xr.Dataset({
-        newname: reshape_var(ds[oldname].values).assign_attrs(attrs)
+        newname: xr.DataArray(arrays[newname], dims=("time", "level"), attrs=attrs)
         for oldname, (newname, attrs) in VARDEFS[kind].items()
     }, coords={
         "time": (("time",), rounded),
@@ -150,3 +290,134 @@ def load_ddh(filename, kind):
     #ds.coords['station_name']= STAT_NR[header["i"].zfill(3)]
     ds.attrs['station_name']= STAT_NR[str(header["i"]).zfill(3)]
     return ds
+
+
+# station-dimensioned zarr store of many DDH files, laid out like the existing ddh_output stores:
+# variables are (station, time), (station, level, time) or (station, halflevel, time) with one chunk
+# per station and `timechunk` steps. The time axis grows at the end, earlier times are inserted
+TIME_REF = np.datetime64("2020-01-01T00:00:00", "s")
+# vertical dimension of the multi-level kinds, fluxes are on half levels
+LEVEL_DIMS = {"atmvar": "level", "atmflx": "halflevel"}
+
+def init_ddh_store(store, timechunk=960):
+    root = zarr.open_group(store, mode="a")
+    if "station" in root:
+        return root
+    stations = sorted(STAT_NR)
+    root.attrs["timechunk"] = timechunk
+    root.create_dataset("time", shape=(0,), chunks=(timechunk,), dtype="i8", fill_value=None)
+    root["time"].attrs.update({"_ARRAY_DIMENSIONS": ["time"], "units": f"seconds since {TIME_REF}",
+                               "calendar": "proleptic_gregorian"})
+    root.array("station", np.array([int(s) for s in stations]), dtype="i8", fill_value=None)
+    root["station"].attrs["_ARRAY_DIMENSIONS"] = ["station"]
+    root.array("station_name", np.array([STAT_NR[s] for s in stations]), dtype="U32", fill_value=None)
+    root["station_name"].attrs["_ARRAY_DIMENSIONS"] = ["station"]
+    for name, units in [("lat", "degrees_north"), ("lon", "degrees_east")]:
+        root.full(name, np.nan, shape=(len(stations),), dtype="f8")
+        root[name].attrs.update({"_ARRAY_DIMENSIONS": ["station"], "units": units})
+    return root
+
+def _store_times(root):
+    return TIME_REF + root["time"][:] * np.timedelta64(1, "s")
+
+def _extend_time(root, times):
+    """
+    adds `times` missing from the time axis of the store and returns the new axis
+
+    times after the end are appended; earlier times (a backfilled day, a station starting
+    earlier) are inserted, which moves the stored steps after them, one station at a time
+    """
+    stored = _store_times(root)
+    new = np.setdiff1d(times, stored)
+    if len(new) == 0:
+        return stored
+    merged = np.union1d(stored, new)
+    first = int(np.searchsorted(stored, new[0]))
+    moved = np.searchsorted(merged, stored[first:]) - first
+    for name, arr in root.arrays():
+        dims = arr.attrs["_ARRAY_DIMENSIONS"]
+        if name == "time" or dims[-1] != "time":
+            continue
+        arr.resize(arr.shape[:-1] + (len(merged),))
+        if first == len(stored):
+            continue
+        for station in range(arr.shape[0]):
+            tail = arr[station, ..., first:len(stored)]
+            block = np.full(tail.shape[:-1] + (len(merged) - first,), arr.fill_value, arr.dtype)
+            block[..., moved] = tail
+            arr[station, ..., first:] = block
+    root["time"].resize((len(merged),))
+    root["time"][first:] = (merged[first:] - TIME_REF) // np.timedelta64(1, "s")
+    return merged
+
+def _ensure_vars(root, kind, levels):
+    ntime = root["time"].shape[0]
+    timechunk = root.attrs["timechunk"]
+    nstation = root["station"].shape[0]
+    levdim = LEVEL_DIMS.get(kind, "level") if len(levels) > 1 else None
+    if levdim:
+        if levdim not in root:
+            root.array(levdim, levels, dtype="i4", fill_value=None)
+            root[levdim].attrs["_ARRAY_DIMENSIONS"] = [levdim]
+        elif not np.array_equal(root[levdim][:], levels):
+            raise ValueError(f"{levdim}s of {kind} differ from the {levdim}s in the store")
+    for oldname, (newname, attrs) in VARDEFS[kind].items():
+        if newname in root:
+            continue
+        shape, chunks, dims = (nstation, ntime), (1, timechunk), ["station", "time"]
+        if levdim:
+            shape, chunks, dims = (nstation, len(levels), ntime), (1, len(levels), timechunk), ["station", levdim, "time"]
+        root.full(newname, np.nan, shape=shape, chunks=chunks, dtype="f8")
+        root[newname].attrs.update({**attrs, "_ARRAY_DIMENSIONS": dims, "coordinates": "station_name lat lon"})
+
+def _write_ddh(root, times, kind, header, rounded, levels, arrays):
+    station = int(np.searchsorted(root["station"][:], header["i"]))
+    if station >= root["station"].shape[0] or root["station"][station] != header["i"]:
+        raise KeyError(f"unknown station {header['i']}")
+    root["lat"][station] = header["north"]
+    root["lon"][station] = header["west"]
+    _ensure_vars(root, kind, levels)
+    tpos = np.searchsorted(times, rounded)
+    contiguous = tpos[-1] - tpos[0] + 1 == len(tpos)
+    with span("write_ddh", station=int(header["i"]), kind=kind) as sp:
+        for oldname, (newname, attrs) in VARDEFS[kind].items():
+            # (time, level) to (level, time)
+            values = arrays[newname].T if len(levels) > 1 else arrays[newname][:, 0]
+            if contiguous:
+                root[newname][station, ..., tpos[0]:tpos[-1] + 1] = values
+            else:
+                root[newname].oindex[(station,) + (slice(None),) * (values.ndim - 1) + (tpos,)] = values
+            sp.add(bytes_written=values.nbytes, elements=values.size)
+
+def ingest_ddh(files, store, workers=None, batchsize=None, timechunk=960):
+    """
+    parse DDH files in parallel and add them to the station-dimensioned zarr `store`
+
+    :param files: iterable of (filename, kind) pairs, best in time order
+    :param batchsize: number of files parsed together, defaults to the number of workers
+
+    while one batch is written the next one is parsed. Times already in the store are
+    overwritten in place and times after its end are appended, so new files can be added
+    later without rewriting the store. Times before the end which are not on the time axis
+    yet are inserted, this rewrites the stored steps after them.
+    """
+    files = list(files)
+    workers = workers or os.cpu_count()
+    batchsize = batchsize or workers
+    batches = [files[i0:i0 + batchsize] for i0 in range(0, len(files), batchsize)]
+    root = init_ddh_store(store, timechunk)
+    with ProcessPoolExecutor(workers) as pool:
+        submit = lambda batch: [pool.submit(ddh_arrays, filename, kind) for filename, kind in batch]
+        queued = submit(batches[0]) if batches else []
+        for ib, batch in enumerate(tqdm.tqdm(batches)):
+            futures = queued
+            if ib + 1 < len(batches):
+                queued = submit(batches[ib + 1])
+            with span("wait_parsed", files=len(futures)):
+                results = [future.result() for future in futures]
+            times = _extend_time(root, np.unique(np.concatenate([r[1] for r in results])))
+            for (filename, kind), (header, rounded, levels, arrays) in zip(batch, results):
+                _write_ddh(root, times, kind, header, rounded, levels, arrays)
+                root.attrs.update({k: header[k] for k in ["exp", "vp", "ty"]})
+    zarr.consolidate_metadata(store)
+    return xr.open_zarr(store)
@@ -0,0 +1,201 @@
+"""
+direct access to the GRIB messages behind gribscan reference indices
+
+A gribscan index maps every chunk (one GRIB message) of every variable to a byte range
+`[url, offset, length]`. Reading chunks through zarr fetches them one at a time; here the
+messages of many variables and time steps are sorted by file and offset, neighbouring
+ranges are merged into a few large reads and the messages are decoded in a thread pool.
+"""
+import os
+import json
+import base64
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import numcodecs
+from numcodecs.compat import ensure_ndarray
+
+
+def strip_protocol(path):
+    return path[len("reference::"):] if path.startswith("reference::") else path
+
+
+def _inline(value):
+    # small chunks (coordinates) are stored inline in the reference file
+    if isinstance(value, bytes):  # already decoded by partitioned references
+        return value
+    if value.startswith("base64:"):
+        return base64.b64decode(value[len("base64:"):])
+    return value.encode()
+
+
+def _json(value):
+    return value if isinstance(value, dict) else json.loads(value)
+
+
+class ReferenceReader:
+    def __init__(self, reference, maxgap=2**16, workers=8, cache_size=16):
+        """
+        :param reference: gribscan/kerchunk reference JSON or partitioned (parquet) references, path or "reference::path"
+        :param maxgap: byte ranges closer than this are read together
+        :param cache_size: partitions kept in memory for partitioned references
+        """
+        self.path = strip_protocol(reference)
+        if os.path.isdir(self.path):
+            from fsspec.implementations.reference import LazyReferenceMapper
+            self.templates = {}
+            self.refs = LazyReferenceMapper(self.path, cache_size=cache_size)
+            metadata = self.refs.zmetadata
+        else:
+            with open(self.path) as infile:
+                refs = json.load(infile)
+            self.templates = refs.get("templates", {})
+            self.refs = metadata = refs.get("refs", refs)
+        self.maxgap = maxgap
+        self.workers = workers
+        self.meta = {key[:-len("/.zarray")]: _json(value)
+                     for key, value in metadata.items() if key.endswith("/.zarray")}
+        self.attrs = {key[:-len("/.zattrs")]: _json(value)
+                      for key, value in metadata.items() if key.endswith("/.zattrs")}
+        self._codecs = {}
+
+    def dims(self, var):
+        return self.attrs[var]["_ARRAY_DIMENSIONS"]
+
+    def variables(self, dim="time"):
+        """
+        variables along `dim`, excluding the coordinate itself
+        """
+        return [var for var in self.meta if var != dim and dim in self.dims(var)]
+
+    def chunk_key(self, var, index):
+        """
+        key of the chunk containing the element at `index` (one integer per dimension)
+        """
+        chunks = self.meta[var]["chunks"]
+        return var + "/" + ".".join(str(i // c) for i, c in zip(index, chunks))
+
+    def keys_at(self, var, position):
+        """
+        [(key, slices), ...] of the chunks making up the field of `var` at `position` ({dim: index}),
+        slices place each chunk in the field of the remaining dimensions
+        """
+        meta = self.meta[var]
+        dims = self.dims(var)
+        free = [i for i, d in enumerate(dims) if d not in position]
+        shape = [meta["shape"][i] for i in free]
+        chunks = [meta["chunks"][i] for i in free]
+        out = []
+        for index in np.ndindex(*[-(-n // c) for n, c in zip(shape, chunks)]):
+            start = dict(zip(free, (i * c for i, c in zip(index, chunks))))
+            full = [start[i] if i in start else position[d] for i, d in enumerate(dims)]
+            out.append((self.chunk_key(var, full),
+                        tuple(slice(start[i], min(start[i] + c, n)) for i, c, n in zip(free, chunks, shape))))
+        return out
+
+    def field_at(self, var, position, chunks):
+        """
+        field of `var` at `position` ({dim: index}) from the decoded `chunks` of `read`
+        """
+        meta = self.meta[var]
+        dims = self.dims(var)
+        out = np.empty([n for d, n in zip(dims, meta["shape"]) if d not in position], dtype=meta["dtype"])
+        for key, slices in self.keys_at(var, position):
+            local = iter(slice(0, s.stop - s.start) for s in slices)
+            index = tuple(position[d] % c if d in position else next(local) for d, c in zip(dims, meta["chunks"]))
+            out[slices] = chunks[key][index]
+        return out
+
+    def step_keys(self, var, it, dim="time"):
+        """
+        [(key, slices), ...] of the chunks making up the field of `var` at index `it` along `dim`,
+        slices place each chunk in the field without `dim`
+        """
+        return self.keys_at(var, {dim: it})
+
+    def field(self, var, it, chunks, dim="time"):
+        """
+        field of `var` at index `it` along `dim` from the decoded `chunks` of `read`
+        """
+        return self.field_at(var, {dim: it}, chunks)
+
+    def url(self, url):
+        for name, value in self.templates.items():
+            url = url.replace("{{" + name + "}}", value)
+        return url
+
+    def ranges(self, keys):
+        """
+        {url: [(start, stop, [(key, offset, length), ...]), ...]}, the merged byte ranges of `keys`
+        """
+        by_url = defaultdict(list)
+        for key in keys:
+            ref = self.refs.get(key)
+            if isinstance(ref, list) and isinstance(ref[0], str):  # missing chunks have no url
+                url, offset, length = ref if len(ref) == 3 else (ref[0], 0, None)
+                by_url[self.url(url)].append((key, offset, length))
+        merged = {}
+        for url, messages in by_url.items():
+            if any(length is None for _, _, length in messages):
+                size = os.path.getsize(url)
+                messages = [(key, offset, size if length is None else length) for key, offset, length in messages]
+            messages.sort(key=lambda m: m[1])
+            spans = []
+            for key, offset, length in messages:
+                if spans and offset - spans[-1][1] <= self.maxgap:
+                    spans[-1][1] = max(spans[-1][1], offset + length)
+                    spans[-1][2].append((key, offset, length))
+                else:
+                    spans.append([offset, offset + length, [(key, offset, length)]])
+            merged[url] = [tuple(span) for span in spans]
+        return merged
+
+    def read_raw(self, keys):
+        """
+        {key: bytes} of the encoded chunks, each merged range is read with a single request
+        """
+        keys = list(keys)
+        raw = {key: _inline(self.refs[key]) for key in keys if isinstance(self.refs[key], (str, bytes))}
+        for url, spans in self.ranges(keys).items():
+            with open(url, "rb") as infile:
+                for start, stop, messages in spans:
+                    infile.seek(start)
+                    block = infile.read(stop - start)
+                    for key, offset, length in messages:
+                        raw[key] = block[offset - start:offset - start + length]
+        return raw
+
+    def codec(self, var):
+        if var not in self._codecs:
+            meta = self.meta[var]
+            if meta.get("compressor") and meta["compressor"]["id"].startswith("gribscan"):
+                import gribscan  # registers the GRIB codec
+            self._codecs[var] = (meta["compressor"] and numcodecs.get_codec(meta["compressor"]),
+                                 [numcodecs.get_codec(f) for f in meta.get("filters") or []])
+        return self._codecs[var]
+
+    def decode(self, key, buf):
+        var = key.rsplit("/", 1)[0]
+        meta = self.meta[var]
+        compressor, filters = self.codec(var)
+        if compressor:
+            buf = compressor.decode(buf)
+        for f in reversed(filters):
+            buf = f.decode(buf)
+        return ensure_ndarray(buf).view(meta["dtype"]).reshape(meta["chunks"])
+
+    def read(self, keys):
+        """
+        {key: array} of the decoded chunks, decoded in a thread pool
+        """
+        keys = list(keys)
+        raw = self.read_raw(key for key in keys if key in self.refs)
+        with ThreadPoolExecutor(self.workers) as pool:
+            chunks = dict(zip(raw, pool.map(self.decode, raw, raw.values())))
+        for key in keys:
+            if key not in chunks:  # missing chunks are filled like in zarr
+                meta = self.meta[key.rsplit("/", 1)[0]]
+                fill = 0 if meta["fill_value"] is None else meta["fill_value"]
+                chunks[key] = np.full(meta["chunks"], fill, dtype=meta["dtype"])
+        return chunks
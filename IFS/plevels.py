@@ -0,0 +1,97 @@
+"""
+subsets of reference-backed IFS pressure-level data (ICMU_atm3d) read straight from the GRIB messages
+
+`data.t.sel(time=..., level=850.)` on the zarr view builds a graph over the whole variable.
+Here a (variable, time, level, bounding box) query is mapped to the GRIB messages of the
+selected times and levels only. The messages of `batch` time steps are fetched with a few
+merged reads and decoded in a thread pool by `gribrefs.ReferenceReader`; the result is a
+dask-backed DataArray with one task per batch.
+
+    pl = LevelSubset("reference::/work/bm1235/a270046/cycle2-sync/tco2559-ng5/ICMUAall/json.dir/atm3d.json")
+    t850 = pl.select("t", time=slice("2020-02-01", "2020-02-29"), level=850., bbox=(33, 72, -30, 60))
+"""
+import itertools
+
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+
+from gribrefs import ReferenceReader
+
+
+class LevelSubset:
+    def __init__(self, reference, maxgap=2**16, workers=8, batch=24):
+        """
+        :param batch: time steps read together, i.e. per dask task
+        """
+        self.reader = ReferenceReader(reference, maxgap=maxgap, workers=workers)
+        # only the coordinates of this view are ever loaded
+        self.ds = xr.open_zarr("reference::" + self.reader.path, consolidated=False)
+        self.batch = batch
+        self._boxes = {}
+
+    def positions(self, dim, labels):
+        """
+        integer positions along `dim` selected by `labels` (anything `.sel` accepts), with their coordinate
+        """
+        index = xr.DataArray(np.arange(self.ds.sizes[dim]), dims=[dim], coords={dim: self.ds[dim]})
+        return index if labels is None else index.sel({dim: labels})
+
+    def box(self, bbox):
+        """
+        indices of the grid points inside bbox = (lat_min, lat_max, lon_min, lon_max), longitudes in -180..180
+        """
+        if bbox not in self._boxes:
+            lat = self.ds.lat.values
+            lon = self.ds.lon.values
+            lon = np.where(lon > 180, lon - 360, lon)
+            lat_min, lat_max, lon_min, lon_max = bbox
+            self._boxes[bbox] = np.flatnonzero((lat >= lat_min) & (lat <= lat_max) &
+                                               (lon >= lon_min) & (lon <= lon_max))
+        return self._boxes[bbox]
+
+    def read_block(self, var, positions, shape, points=None):
+        """
+        fields of `var` at `positions` ([{dim: index}, ...]) with all their messages read together
+        """
+        chunks = self.reader.read(key for position in positions for key, _ in self.reader.keys_at(var, position))
+        fields = np.stack([self.reader.field_at(var, position, chunks) for position in positions])
+        if points is not None:
+            fields = fields[..., points]
+        return fields.reshape(shape)
+
+    def select(self, var, time=None, level=None, bbox=None):
+        """
+        lazy DataArray of `var` at the selected times and levels (labels like in `.sel`), optionally in bbox
+
+        dimensions selected with a scalar are dropped like in `.sel`
+        """
+        dims = self.reader.dims(var)
+        selected = {dim: self.positions(dim, labels) for dim, labels in (("time", time), ("level", level))
+                    if dim in dims}
+        outer = [dim for dim in dims if dim in selected]
+        inner = [dim for dim in dims if dim not in selected]
+        points = None if bbox is None else self.box(bbox)
+        inner_shape = [self.ds.sizes[dim] for dim in inner]
+        if points is not None:
+            inner_shape[-1] = len(points)
+
+        # one task per batch of time steps, all selected levels of a step are read with it
+        indices = {dim: np.atleast_1d(selected[dim].values) for dim in outer}
+        first, rest = outer[0], outer[1:]
+        blocks = []
+        for start in range(0, len(indices[first]), self.batch):
+            steps = indices[first][start:start + self.batch]
+            positions = [dict(zip(outer, combo)) for combo in itertools.product(steps, *(indices[d] for d in rest))]
+            shape = (len(steps),) + tuple(len(indices[d]) for d in rest) + tuple(inner_shape)
+            block = dask.delayed(self.read_block, pure=False)(var, positions, shape, points)
+            blocks.append(da.from_delayed(block, shape, dtype=self.reader.meta[var]["dtype"]))
+        data = da.concatenate(blocks, axis=0)[tuple(slice(None) if selected[dim].ndim else 0 for dim in outer)]
+
+        coords = {dim: selected[dim][dim] for dim in outer}
+        for name, coord in self.ds.coords.items():
+            if coord.dims == tuple(inner[-1:]):
+                coords[name] = coord if points is None else coord.isel({inner[-1]: points})
+        keep = [dim for dim in outer if selected[dim].ndim] + inner
+        return xr.DataArray(data, dims=keep, coords=coords, name=var, attrs=self.ds[var].attrs)
@@ -0,0 +1,173 @@
+"""
+daily or monthly aggregates of reference-backed IFS GRIB data
+
+All variables of a period are reduced in one pass over the archive: the messages of each
+time step are fetched for all variables together, in file order, through
+`gribrefs.ReferenceReader`, instead of reading the archive once per variable.
+Completed periods are appended to one time-chunked zarr store, a restarted run
+continues after the last period in the store. Stored periods with fewer time steps than
+the archive now has, e.g. the last day of a running experiment, are recomputed in place.
+
+    python reduce_ifs.py reference::/path/to/atm2d.json sst.daily.zarr --variables sst 2t --freq D
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from gribrefs import ReferenceReader
+
+
+class Aggregate:
+    """
+    running mean / min / max of a field, NaNs are skipped like in `.mean(skipna=True)`
+    """
+    def __init__(self, stats=("mean",)):
+        self.stats = stats
+        self.sums = self.counts = self.min = self.max = None
+
+    def add(self, field):
+        valid = np.isfinite(field)
+        if self.sums is None:
+            self.sums = np.zeros(field.shape, "f8")
+            self.counts = np.zeros(field.shape, "i4")
+            self.min = np.full(field.shape, np.nan, field.dtype)
+            self.max = np.full(field.shape, np.nan, field.dtype)
+        self.sums += np.where(valid, field, 0)
+        self.counts += valid
+        if "min" in self.stats:
+            np.fmin(self.min, field, out=self.min)
+        if "max" in self.stats:
+            np.fmax(self.max, field, out=self.max)
+
+    def result(self, stat, dtype):
+        if stat == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return np.where(self.counts > 0, self.sums / self.counts, np.nan).astype(dtype)
+        return getattr(self, stat)
+
+
+def period_groups(times, freq="D"):
+    """
+    (period start, time indices) of every day ("D") or month ("M")
+    """
+    periods = pd.DatetimeIndex(times).to_period(freq)
+    for period in periods.unique():
+        yield period.start_time, np.flatnonzero(periods == period)
+
+
+def stored_periods(store):
+    """
+    {period start: number of time steps} of the periods in `store`, in store order
+    """
+    if not os.path.exists(os.path.join(store, ".zgroup")):
+        return {}
+    stored = xr.open_zarr(store)
+    return dict(zip(pd.DatetimeIndex(stored.time.values), stored.nsteps.values.tolist()))
+
+
+def read_steps(reader, variables, itimes, dim="time"):
+    """
+    decoded chunks of all variables, one time step at a time, the next step is read in the background
+    """
+    keys = lambda it: [key for var in variables for key, _ in reader.step_keys(var, it, dim)]
+    with ThreadPoolExecutor(1) as prefetch:
+        future = prefetch.submit(reader.read, keys(itimes[0]))
+        for i, it in enumerate(itimes):
+            chunks = future.result()
+            if i + 1 < len(itimes):
+                future = prefetch.submit(reader.read, keys(itimes[i + 1]))
+            yield it, chunks
+
+
+def reduce_period(reader, ds, variables, start, itimes, stats=("mean",)):
+    aggregates = {var: Aggregate(stats) for var in variables}
+    for it, chunks in read_steps(reader, variables, itimes):
+        for var in variables:
+            aggregates[var].add(reader.field(var, it, chunks))
+
+    data_vars = {}
+    for var in variables:
+        dims = [d for d in ds[var].dims if d != "time"]
+        for stat in stats:
+            name = var if stat == "mean" else f"{var}_{stat}"
+            data_vars[name] = xr.DataArray(aggregates[var].result(stat, ds[var].dtype)[np.newaxis],
+                                           dims=["time"] + dims,
+                                           attrs={**ds[var].attrs, "cell_methods": f"time: {stat}"})
+    data_vars["nsteps"] = xr.DataArray([len(itimes)], dims=["time"],
+                                       attrs={"long_name": "number of time steps in the period"})
+    coords = {name: coord for name, coord in ds.coords.items() if "time" not in coord.dims}
+    return xr.Dataset(data_vars, coords={"time": [start], **coords})
+
+
+def append_periods(store, periods, timechunk=1):
+    out = xr.concat(periods, dim="time")
+    if os.path.exists(os.path.join(store, ".zgroup")):
+        out = out.drop_vars([name for name in out.variables if "time" not in out[name].dims])
+        out.to_zarr(store, append_dim="time")
+    else:
+        out.to_zarr(store, mode="w-", encoding={
+            name: {"chunks": (timechunk,) + out[name].shape[1:]}
+            for name in out.data_vars})
+
+
+def replace_period(store, period, index):
+    period = period.drop_vars([name for name in period.variables if "time" not in period[name].dims])
+    period.to_zarr(store, region={"time": slice(index, index + 1)})
+
+
+def reduce_reference(reference, store, variables=None, freq="D", stats=("mean",), timechunk=1,
+                     workers=8, maxgap=2**16):
+    """
+    aggregate `variables` (default all along time) of a reference index per day or month into `store`
+
+    :param freq: "D" for daily, "M" for monthly aggregates
+    :param stats: any of "mean", "min", "max"
+    :param timechunk: periods per chunk in the store, they are appended together
+    """
+    reader = ReferenceReader(reference, maxgap=maxgap, workers=workers)
+    ds = xr.open_zarr("reference::" + reader.path, consolidated=False)
+    variables = list(variables or reader.variables())
+    stored = stored_periods(store)
+    positions = {start: i for i, start in enumerate(stored)}
+    done = max(stored, default=None)
+    pending = []
+    for start, itimes in period_groups(ds.time.values, freq):
+        if stored.get(start) == len(itimes) or (start not in stored and done is not None and start < done):
+            continue
+        t0 = time.time()
+        period = reduce_period(reader, ds, variables, start, itimes, stats)
+        print(f"{start:%Y-%m-%d}: {len(itimes)} steps of {len(variables)} variables in {time.time() - t0:.1f} sec")
+        if start in stored:
+            # stored while the period was incomplete
+            replace_period(store, period, positions[start])
+            continue
+        pending.append(period)
+        if len(pending) == timechunk:
+            append_periods(store, pending, timechunk)
+            pending = []
+    if pending:
+        append_periods(store, pending, timechunk)
+    return xr.open_zarr(store)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("reference", help="gribscan reference JSON, with or without reference::")
+    parser.add_argument("store", help="output zarr store, appended to if it exists")
+    parser.add_argument("--variables", nargs="*", default=None)
+    parser.add_argument("--freq", choices=["D", "M"], default="D")
+    parser.add_argument("--stats", nargs="*", choices=["mean", "min", "max"], default=["mean"])
+    parser.add_argument("--timechunk", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=8, help="threads decoding GRIB messages")
+    args = parser.parse_args()
+    reduce_reference(args.reference, args.store, args.variables, args.freq, tuple(args.stats),
+                     args.timechunk, args.workers)
+
+
+if __name__ == "__main__":
+    main()
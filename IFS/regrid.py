@@ -0,0 +1,116 @@
+"""
+regridding from unstructured grids (IFS reduced Gaussian, FESOM nodes, ICON cells) to a regular lat/lon box
+
+Nearest-neighbour or barycentric-linear weights are computed once per (source grid,
+target grid) as a sparse (target, source) matrix and cached on disk. Regridding is then
+a sparse matrix product per chunk, for any number of time steps and levels, instead of
+a new `NearestNDInterpolator` / `LinearNDInterpolator` (and Delaunay triangulation) per field.
+Only source points in the target box (plus `margin` degrees) enter the triangulation.
+
+    rg = Regridder.cached(model_lon, model_lat, lon, lat, "tco2559", cachedir, method="linear")
+    t850 = rg(data.t.sel(level=850.), dim="value")
+"""
+import os
+import hashlib
+
+import numpy as np
+import xarray as xr
+import scipy.sparse
+from scipy.spatial import cKDTree, Delaunay
+
+
+def nearest_weights(points, targets):
+    _, index = cKDTree(points).query(targets, workers=-1)
+    return np.arange(len(targets))[:, np.newaxis], index[:, np.newaxis], np.ones((len(targets), 1))
+
+
+def linear_weights(points, targets):
+    # barycentric coordinates in the triangle containing each target, as in LinearNDInterpolator
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(targets)
+    inside = np.flatnonzero(simplex >= 0)
+    transform = tri.transform[simplex[inside]]
+    bary = np.einsum("ijk,ik->ij", transform[:, :2], targets[inside] - transform[:, 2])
+    weights = np.column_stack([bary, 1 - bary.sum(axis=1)])
+    return inside[:, np.newaxis], tri.simplices[simplex[inside]], weights
+
+
+METHODS = {"nearest": nearest_weights, "linear": linear_weights}
+
+
+class Regridder:
+    def __init__(self, matrix, lon, lat):
+        """
+        :param matrix: sparse (target, source) weights, targets ordered like meshgrid(lon, lat)
+        """
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.lon = np.asarray(lon)
+        self.lat = np.asarray(lat)
+        # targets without any source (outside the convex hull) are NaN
+        self.valid = np.diff(self.matrix.indptr) > 0
+
+    @classmethod
+    def build(cls, model_lon, model_lat, lon, lat, method="nearest", margin=2.0):
+        """
+        :param model_lon, model_lat: coordinates of the source points, in the same longitude range as `lon`
+        :param lon, lat: 1d axes of the regular target grid
+        """
+        model_lon, model_lat = np.asarray(model_lon), np.asarray(model_lat)
+        box = np.flatnonzero((model_lon >= np.min(lon) - margin) & (model_lon <= np.max(lon) + margin) &
+                             (model_lat >= np.min(lat) - margin) & (model_lat <= np.max(lat) + margin))
+        lon2, lat2 = np.meshgrid(lon, lat)
+        targets = np.column_stack([lon2.ravel(), lat2.ravel()])
+        rows, cols, weights = METHODS[method](np.column_stack([model_lon[box], model_lat[box]]), targets)
+        rows = np.broadcast_to(rows, cols.shape)
+        matrix = scipy.sparse.csr_matrix((weights.ravel(), (rows.ravel(), box[cols].ravel())),
+                                         shape=(len(targets), len(model_lon)))
+        return cls(matrix, lon, lat)
+
+    @classmethod
+    def cached(cls, model_lon, model_lat, lon, lat, grid_id, cachedir, method="nearest", margin=2.0):
+        """
+        load the weights of grid_id from cachedir, or build and store them. The file name contains a hash
+        of the source and target coordinates, so a changed grid never picks up stale weights
+        """
+        h = hashlib.blake2b(digest_size=8)
+        for a in (model_lon, model_lat, lon, lat):
+            h.update(np.ascontiguousarray(a, "f8").tobytes())
+        h.update(f"{margin:g}".encode())
+        fname = os.path.join(cachedir, f"{method}_{grid_id}_{len(lat)}x{len(lon)}_{h.hexdigest()}.npz")
+        if os.path.isfile(fname):
+            return cls(scipy.sparse.load_npz(fname), lon, lat)
+        regridder = cls.build(model_lon, model_lat, lon, lat, method, margin)
+        os.makedirs(cachedir, exist_ok=True)
+        with open(fname + ".tmp", "wb") as f:
+            scipy.sparse.save_npz(f, regridder.matrix)
+        os.replace(fname + ".tmp", fname)
+        return regridder
+
+    def apply(self, values):
+        """
+        regrid a numpy array (..., point) to (..., lat, lon)
+        """
+        values = np.asarray(values)
+        shape = values.shape[:-1]
+        flat = values.reshape(-1, values.shape[-1])
+        out = (self.matrix @ flat.T).T
+        out[:, ~self.valid] = np.nan
+        dtype = values.dtype if values.dtype.kind == "f" else "f8"
+        return out.astype(dtype, copy=False).reshape(shape + (len(self.lat), len(self.lon)))
+
+    def __call__(self, data, dim):
+        """
+        regrid a DataArray or all variables of a Dataset along `dim`, lazily for dask arrays
+
+        `dim` has to be a single chunk, other dimensions (time, level) may be chunked freely
+        """
+        if isinstance(data, xr.Dataset):
+            return xr.Dataset({name: self(var, dim) for name, var in data.data_vars.items() if dim in var.dims})
+        if data.chunks is not None:
+            data = data.chunk({dim: -1})
+        dtype = data.dtype if data.dtype.kind == "f" else "f8"
+        out = xr.apply_ufunc(self.apply, data.drop_vars([c for c in data.coords if dim in data[c].dims]),
+                             input_core_dims=[[dim]], output_core_dims=[["lat", "lon"]],
+                             dask="parallelized", output_dtypes=[dtype],
+                             dask_gufunc_kwargs={"output_sizes": {"lat": len(self.lat), "lon": len(self.lon)}})
+        return out.assign_coords(lat=self.lat, lon=self.lon).assign_attrs(data.attrs)
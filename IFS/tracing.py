@@ -0,0 +1 @@
+../tracing.py
\ No newline at end of file
@@ -0,0 +1,284 @@
+import os
+import argparse
+import json
+import base64
+import hashlib
+import fnmatch
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+import netCDF4
+
+# per experiment: the output folders under `root` matching `folders`, the folder
+# whose files define the collections, and for each collection the length of the
+# time dimension which identifies its files. The original collections are opened
+# through reference files in `reference_dir`
+EXPERIMENTS = {
+    "tco3999-ng5": {
+        "root": "/work/bm1235/a270046/cycle2-sync/tco3999-ng5",
+        "folders": "*_tco3999_fesom",
+        "index_folder": "04_07Feb-12Feb2020_tco3999_fesom",
+        "reference_dir": "/work/bm1235/a270046/cycle2-sync/tco3999-ng5/references",
+        "collections": [("3d", 48, {"time": 1, "nz": 1, "nz1": 1}), ("2d", 144, {"time": 1})],
+        "sources": {
+            "np": {
+                "description": "nearest-neighbor interpolation to lat-lon grid",
+                "driver": "zarr",
+                "args": {
+                    "urlpath": "reference::/home/m/m300827/nextgems/C2_hackathon_prep/tco3999-ng5_np.json",
+                    "consolidated": False,
+                },
+            },
+        },
+    },
+    "tco2559-ng5": {
+        "root": "/work/bm1235/a270046/cycle2-sync/tco2559-ng5",
+        "folders": "*_fesom",
+        "index_folder": "04_01Apr-30Apr2020_fesom",
+        "reference_dir": "/work/bm1235/a270046/cycle2-sync/tco2559-ng5/references",
+        "collections": [("3d", 240, {"time": 1, "nz": 1, "nz1": 1}), ("2d", 720, {"time": 1})],
+        "sources": {},
+    },
+}
+
+GRID_SOURCES = {
+    "node_grid": {
+        "driver": "netcdf",
+        "args": {
+            "urlpath": "/work/bm1235/a270046/meshes/NG5_griddes_nodes_IFS.nc",
+        },
+    },
+    "elem_grid": {
+        "driver": "netcdf",
+        "args": {
+            "urlpath": "/work/bm1235/a270046/meshes/NG5_griddes_elems_IFS.nc",
+        },
+    },
+}
+
+PLUGINS = {
+    "source": [
+        {"module": "intake_xarray"},
+        {"module": "gribscan"},
+    ],
+}
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fesom_metadata.json")
+
+
+def scan_files(root, folders, pattern="*fesom*.nc"):
+    # one listing of root and of every matching folder: {folder: {filename: path}}
+    files = {}
+    for folder in sorted(os.scandir(root), key=lambda e: e.name):
+        if folder.is_dir() and fnmatch.fnmatch(folder.name, folders):
+            files[folder.name] = {f.name: f.path for f in os.scandir(folder.path)
+                                  if f.is_file() and fnmatch.fnmatch(f.name, pattern)}
+    return files
+
+
+def read_dims(path):
+    # only the header is read
+    with netCDF4.Dataset(path) as nc:
+        return {name: len(dim) for name, dim in nc.dimensions.items()}
+
+
+class MetadataCache:
+    # header dimensions of files, an entry is valid as long as mtime and size are unchanged
+    def __init__(self, filename=CACHE_FILE):
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename) as infile:
+                self.entries = json.load(infile)
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def dims(self, paths, workers=None):
+        keys = {path: self.key(path) for path in paths}
+        todo = [path for path in paths
+                if path not in self.entries or self.entries[path]["key"] != keys[path]]
+        if todo:
+            with ProcessPoolExecutor(workers) as pool:
+                for path, dims in zip(todo, pool.map(read_dims, todo, chunksize=16)):
+                    self.entries[path] = {"key": keys[path], "dims": dims}
+            self.save()
+        return {path: self.entries[path]["dims"] for path in paths}
+
+    def save(self):
+        with open(self.filename + ".tmp", "w") as outfile:
+            json.dump(self.entries, outfile)
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+def encode_value(v):
+    try:
+        return v.decode("ascii")
+    except UnicodeDecodeError:
+        return "base64:" + base64.b64encode(v).decode("ascii")
+
+
+def fix_time(single):
+    # common time units in all files, so MultiZarrToZarr can concatenate them
+    import xarray as xr
+    t = xr.open_dataset(
+        "reference://", engine="zarr",
+        backend_kwargs={
+            "storage_options": {
+                "fo": single,
+            },
+            "consolidated": False
+        }
+    )[["time"]].compute()
+    t.time.encoding = {}
+    m = {}
+    t.to_zarr(m, encoding={"time": {"units": "seconds since 1990-01-01", "dtype": "i4", "compressor": None}})
+    return {
+        "version": single["version"],
+        "templates": single.get("templates", {}),
+        "refs": {
+            **single["refs"],
+            **{k: encode_value(v) for k, v in m.items() if k.startswith("time/")}
+        }
+    }
+
+
+def single_references(path):
+    import fsspec
+    with fsspec.open(path) as inf:
+        if inf.read(3) == b"CDF":
+            import kerchunk.netCDF3
+            return fix_time(kerchunk.netCDF3.NetCDF3ToZarr(path, inline_threshold=100).translate())
+        import kerchunk.hdf
+        inf.seek(0)
+        return fix_time(kerchunk.hdf.SingleHdf5ToZarr(inf, path, inline_threshold=100).translate())
+
+
+class ReferenceCache:
+    # byte-range references of single files, kept as long as mtime and size are unchanged
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def filename(self, path):
+        return os.path.join(self.folder, hashlib.blake2b(path.encode(), digest_size=8).hexdigest() + ".json")
+
+    def load(self, path):
+        try:
+            with open(self.filename(path)) as infile:
+                entry = json.load(infile)
+        except (OSError, ValueError):
+            return None
+        return entry["refs"] if entry["key"] == MetadataCache.key(path) else None
+
+    def references(self, paths, workers=None):
+        singles = {path: self.load(path) for path in paths}
+        todo = [path for path, refs in singles.items() if refs is None]
+        if todo:
+            with ProcessPoolExecutor(workers) as pool:
+                for path, refs in zip(todo, pool.map(single_references, todo)):
+                    with open(self.filename(path) + ".tmp", "w") as outfile:
+                        json.dump({"path": path, "key": MetadataCache.key(path), "refs": refs}, outfile)
+                    os.replace(self.filename(path) + ".tmp", self.filename(path))
+                    singles[path] = refs
+        return [singles[path] for path in paths]
+
+
+def build_references(paths, outfile, identical_dims=(), workers=None, cache=None, fmt="json"):
+    # one consolidated reference set for all files of a collection, concatenated along time
+    # and merged across variables. Only new or changed files are scanned again.
+    from kerchunk.combine import MultiZarrToZarr
+    cache = cache or ReferenceCache(os.path.join(os.path.dirname(outfile), "singles"))
+    mzz = MultiZarrToZarr(
+        cache.references(paths, workers),
+        concat_dims=["time"],
+        identical_dims=list(identical_dims),
+    )
+    out = mzz.translate()
+    if fmt == "parquet":
+        import kerchunk.df
+        kerchunk.df.refs_to_dataframe(out, outfile)
+    else:
+        with open(outfile + ".tmp", "w") as f:
+            json.dump(out, f)
+        os.replace(outfile + ".tmp", outfile)
+    return outfile
+
+
+def find_paths(config, cache, workers=None):
+    files = scan_files(config["root"], config["folders"])
+    index = files.get(config["index_folder"], {})
+    dims = cache.dims(list(index.values()), workers)
+    names_by_time = defaultdict(set)
+    for name, path in index.items():
+        names_by_time[dims[path]["time"]].add(name)
+
+    for name, size, chunks in config["collections"]:
+        yield name, chunks, sorted(path
+                                   for folder in files.values()
+                                   for fn, path in folder.items() if fn in names_by_time[size])
+
+
+def original_sources(experiment, config, cache, workers=None, references=True, fmt="json"):
+    for name, chunks, paths in find_paths(config, cache, workers):
+        netcdf = {
+            "description": f"original {name} output",
+            "driver": "netcdf",
+            "args": {
+                "urlpath": paths,
+                "chunks": chunks,
+            }
+        }
+        if not references:
+            yield f"original_{name}", netcdf
+            continue
+        suffix = "parq" if fmt == "parquet" else "json"
+        outfile = build_references(paths, os.path.join(config["reference_dir"], f"{experiment}_original_{name}.{suffix}"),
+                                   identical_dims=[dim for dim in chunks if dim != "time"],
+                                   workers=workers, fmt=fmt)
+        yield f"original_{name}", {
+            "description": f"original {name} output",
+            "driver": "zarr",
+            "args": {
+                "urlpath": f"reference::{outfile}",
+                "consolidated": False,
+            }
+        }
+        # the single files stay available, e.g. for files which can't be referenced
+        yield f"original_{name}_netcdf", netcdf
+
+
+def build_catalog(experiment, outfile=None, workers=None, cache=None, references=True, fmt="json"):
+    config = EXPERIMENTS[experiment]
+    cache = cache or MetadataCache()
+    sources = {
+        **dict(original_sources(experiment, config, cache, workers, references, fmt)),
+        **config["sources"],
+        **GRID_SOURCES,
+    }
+    with open(outfile or f"{experiment}.yaml", "w") as outfile:
+        yaml.dump({
+            "plugins": PLUGINS,
+            "sources": sources,
+        }, outfile)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("experiments", nargs="*", default=list(EXPERIMENTS))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-references", action="store_true",
+                        help="list the NetCDF files in the catalog instead of building reference files")
+    parser.add_argument("--format", choices=["json", "parquet"], default="json")
+    args = parser.parse_args()
+    cache = MetadataCache()
+    for experiment in args.experiments:
+        build_catalog(experiment, workers=args.workers, cache=cache,
+                      references=not args.no_references, fmt=args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import json
+import argparse
+
+import yaml
+import zarr
+
+
+def expand_templates(refs):
+    # references with the templates of their file filled in, so references of several files can be combined
+    templates = refs.get("templates", {})
+    refs = refs.get("refs", refs)
+    if not templates:
+        return refs
+
+    def expand(url):
+        for name, value in templates.items():
+            url = url.replace("{{" + name + "}}", value)
+        return url
+    return {key: [expand(ref[0])] + ref[1:] if isinstance(ref, list) else ref for key, ref in refs.items()}
+
+
+def source_key(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def variables(refs):
+    # top level arrays of a reference set
+    return sorted({key.split("/")[0] for key in refs if key.endswith("/.zarray")})
+
+
+def attributes(refs, var):
+    return json.loads(refs[var + "/.zattrs"])
+
+
+def coordinates(refs):
+    # arrays named after one of their dimensions (time, lat, lon) and auxiliary coordinates
+    # listed in the `coordinates` attribute of any array (latitude, longitude)
+    names = variables(refs)
+    aux = {name for var in names for name in attributes(refs, var).get("coordinates", "").split()}
+    return [var for var in names if var in attributes(refs, var)["_ARRAY_DIMENSIONS"] or var in aux]
+
+
+def array_refs(refs, var):
+    return {key: value for key, value in refs.items() if key.split("/")[0] == var}
+
+
+def inline_refs(refs, var):
+    # metadata and inlined chunks, chunks in the files themselves are not compared
+    return {key: value for key, value in array_refs(refs, var).items() if not isinstance(value, list)}
+
+
+def consolidate(refs):
+    # zarr consolidated metadata of the merged arrays, so the dataset opens with a single read
+    meta = {key: value.encode() if isinstance(value, str) else value
+            for key, value in refs.items() if key.rsplit("/", 1)[-1] in (".zgroup", ".zattrs", ".zarray")}
+    zarr.consolidate_metadata(meta)
+    return meta[".zmetadata"].decode()
+
+
+def merge_references(paths, outfile, force=False):
+    # one reference set for per-variable reference files sharing their coordinates.
+    # An existing `outfile` is updated: only new or changed files are read again.
+    merged = {"version": 1, "refs": {}, "sources": {}}
+    if not force and os.path.exists(outfile):
+        with open(outfile) as infile:
+            merged = json.load(infile)
+    refs, sources = merged["refs"], merged["sources"]
+
+    # files no longer listed or changed since the last merge are removed first, together with
+    # the shared arrays no unchanged file provides any more (e.g. a time axis which has grown)
+    removed = [path for path in sources if path not in paths or sources[path]["key"] != source_key(path)]
+    for path in removed:
+        for var in sources.pop(path)["variables"]:
+            for key in array_refs(refs, var):
+                del refs[key]
+    if removed and not sources:
+        refs.clear()
+    elif removed:
+        provided = set().union(*(source.get("arrays", source["variables"]) for source in sources.values()))
+        for var in variables(refs):
+            if var not in provided:
+                for key in array_refs(refs, var):
+                    del refs[key]
+    todo = [path for path in paths if path not in sources]
+    if not todo:
+        return outfile
+
+    singles = {}
+    for path in todo:
+        with open(path) as infile:
+            singles[path] = expand_templates(json.load(infile))
+    # arrays found in every file are shared like coordinates, the first file provides them
+    arrays = [set(variables(single)) for single in singles.values()]
+    arrays += [set(source.get("arrays", source["variables"])) for source in sources.values()]
+    common = set.intersection(*arrays) if len(paths) > 1 else set()
+
+    for path, single in singles.items():
+        shared = set(coordinates(single)) | (set(variables(single)) & common)
+        for var in sorted(shared):
+            for source in sources.values():  # merged as a variable while there was only one file
+                if var in source["variables"]:
+                    source["variables"].remove(var)
+            if var + "/.zarray" not in refs:
+                refs.update(array_refs(single, var))
+            elif inline_refs(single, var) != inline_refs(refs, var):
+                raise ValueError(f"{path}: coordinate {var} differs from the other files")
+        for key in (".zgroup", ".zattrs"):
+            if key in single and key not in refs:
+                refs[key] = single[key]
+        data_vars = [var for var in variables(single) if var not in shared]
+        if not data_vars:
+            raise ValueError(f"{path}: no variables besides the ones shared with the other files")
+        for var in data_vars:
+            if var + "/.zarray" in refs:
+                raise ValueError(f"{path}: variable {var} is already in {outfile}")
+            refs.update(array_refs(single, var))
+        sources[path] = {"key": source_key(path), "variables": data_vars, "arrays": variables(single)}
+
+    refs.pop(".zmetadata", None)
+    refs[".zmetadata"] = consolidate(refs)
+    with open(outfile + ".tmp", "w") as f:
+        json.dump(merged, f)
+    os.replace(outfile + ".tmp", outfile)
+    print(f"{outfile}: {len(todo)} files merged, {len(variables(refs))} arrays")
+    return outfile
+
+
+def merged_path(paths):
+    # above the per-variable folders <var>/netcdf/<name>.json, e.g. .../IFS4.5/tco2559-ng5_pc.merged.json
+    names = {os.path.splitext(os.path.basename(path))[0] for path in paths}
+    name = names.pop() if len(names) == 1 else "merged"
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(paths[0]))), f"{name}.merged.json")
+
+
+def merged_source(source, force=False):
+    # a source combining a list of reference files, opened as one consolidated virtual dataset.
+    # The list is kept in the source metadata: files appended to it are merged in the next run
+    args = source.get("args", {})
+    urlpath = args.get("urlpath")
+    if source.get("driver") != "zarr":
+        return source
+    urls = urlpath if isinstance(urlpath, list) else source.get("metadata", {}).get("merged_from")
+    if not urls or not all(url.startswith("reference::") for url in urls):
+        return source
+    paths = [url[len("reference::"):] for url in urls]
+    outfile = merge_references(paths, merged_path(paths), force)
+    if not isinstance(urlpath, list):  # already points at the merged (or partitioned) references
+        return source
+    args ={key: value for key, value in args.items() if key not in ("combine", "compat", "concat_dim")}
+    return {**source,
+            "args": {**args, "urlpath": "reference::" + outfile, "consolidated": True},
+            "metadata": {**source.get("metadata", {}), "merged_from": urls}}
+
+
+def merge_catalog(catalog, outfile=None, force=False):
+    with open(catalog) as infile:
+        cat = yaml.safe_load(infile)
+    cat["sources"] = {name: merged_source(source, force) for name, source in cat["sources"].items()}
+    with open(outfile or catalog, "w") as outfile:
+        yaml.dump(cat, outfile, sort_keys=False)
+
+
+def add_references(paths, outfile):
+    # add (or update) variables of `paths` to an existing merged reference set
+    with open(outfile) as infile:
+        merged = list(json.load(infile)["sources"])
+    return merge_references(merged + [path for path in paths if path not in merged], outfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="merge the reference lists of IFS catalog sources into one dataset")
+    parser.add_argument("catalogs", nargs="*")
+    parser.add_argument("--add", nargs="+", metavar=("MERGED", "REFERENCE"),
+                        help="add reference files to a merged reference set")
+    parser.add_argument("--force", action="store_true", help="merge all files again")
+    args = parser.parse_args()
+    if args.add:
+        add_references(args.add[1:], args.add[0])
+    for catalog in args.catalogs:
+        merge_catalog(catalog, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import math
+import json
+import shutil
+import argparse
+
+import yaml
+
+from merge_references import expand_templates, merged_source
+
+# references per partition file, rounded to whole time steps of every variable
+RECORD_SIZE = 10000
+# partitions kept in memory per open dataset
+CACHE_SIZE = 16
+
+
+def chunks_per_step(refs, dim="time"):
+    # number of chunks making up one step along `dim` for every variable along it
+    steps = {}
+    for key, value in refs.items():
+        if key.endswith("/.zarray"):
+            var = key[:-len("/.zarray")]
+            dims = json.loads(refs[var + "/.zattrs"])["_ARRAY_DIMENSIONS"]
+            meta = json.loads(value)
+            if dim in dims and var != dim:
+                steps[var] = math.prod(-(-n // c) for d, n, c in zip(dims, meta["shape"], meta["chunks"]) if d != dim)
+    return steps
+
+
+def record_size(refs, target=RECORD_SIZE, dim="time"):
+    # partitions are split by variable and hold whole time steps: a multiple of the chunks per step of all variables
+    step = math.lcm(*chunks_per_step(refs, dim).values()) or 1
+    return step * max(1, target // step)
+
+
+def partitioned_path(reference):
+    return os.path.splitext(reference)[0] + ".parq"
+
+
+def partition_references(reference, outdir=None, target=RECORD_SIZE, force=False):
+    # write the references of a (gribscan) JSON file as partitioned parquet files, one set per variable,
+    # up-to-date output is kept
+    import kerchunk.df
+    outdir = outdir or partitioned_path(reference)
+    if not force and os.path.isdir(outdir) and os.path.getmtime(outdir) >= os.path.getmtime(reference):
+        return outdir
+    with open(reference) as infile:
+        refs = expand_templates(json.load(infile))
+    size = record_size(refs, target)
+    shutil.rmtree(outdir + ".tmp", ignore_errors=True)
+    kerchunk.df.refs_to_dataframe(refs, outdir + ".tmp", record_size=size)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.replace(outdir + ".tmp", outdir)
+    print(f"{reference}: {len(refs)} references, {size} per partition")
+    return outdir
+
+
+def lazy_source(source, cache_size=CACHE_SIZE, target=RECORD_SIZE, force=False):
+    # the same catalog source opened through partitioned references, partitions are loaded on demand
+    args = source.get("args", {})
+    urlpath = args.get("urlpath")
+    if source.get("driver") != "zarr" or not isinstance(urlpath, str) or not urlpath.startswith("reference::") \
+            or not urlpath.endswith(".json"):
+        return source
+    outdir = partition_references(urlpath[len("reference::"):], target=target, force=force)
+    storage_options = args.get("storage_options", {})
+    return {**source, "args": {
+        **args,
+        "urlpath": "reference::" + outdir,
+        # the partitioned references hold all metadata in memory already
+        "consolidated": False,
+        "storage_options": {**storage_options, "reference": {**storage_options.get("reference", {}),
+                                                             "cache_size": cache_size}},
+    }}
+
+
+def try_merged_source(name, source, force=False):
+    # lists of reference files merged into one reference set, sources which can't be merged are kept as they are
+    try:
+        return merged_source(source, force)
+    except (OSError, ValueError) as e:
+        print(f"{name}: not merged, {e}")
+        return source
+
+
+def partition_catalog(catalog, outfile=None, cache_size=CACHE_SIZE, target=RECORD_SIZE, force=False, merge=True):
+    with open(catalog) as infile:
+        cat = yaml.safe_load(infile)
+    if merge:
+        cat["sources"] = {name: try_merged_source(name, source, force) for name, source in cat["sources"].items()}
+    cat["sources"] = {name: lazy_source(source, cache_size, target, force) for name, source in cat["sources"].items()}
+    with open(outfile or catalog, "w") as outfile:
+        yaml.dump(cat, outfile, sort_keys=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="point the reference sources of IFS catalogs at partitioned references")
+    parser.add_argument("catalogs", nargs="+")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, help="partitions kept in memory")
+    parser.add_argument("--record-size", type=int, default=RECORD_SIZE, help="references per partition")
+    parser.add_argument("--force", action="store_true", help="rebuild up-to-date partitions")
+    parser.add_argument("--no-merge", dest="merge", action="store_false",
+                        help="don't merge lists of reference files into one reference set first (see merge_references.py)")
+    args = parser.parse_args()
+    for catalog in args.catalogs:
+        partition_catalog(catalog, cache_size=args.cache_size, target=args.record_size, force=args.force,
+                          merge=args.merge)
+
+
+if __name__ == "__main__":
+    main()
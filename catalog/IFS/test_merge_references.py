@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import base64
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from merge_references import merge_references, add_references
+
+TIME = pd.date_range("2020-01-20", periods=4, freq="h")
+LAT = np.linspace(-10, 10, 3)
+LON = np.linspace(0, 20, 5)
+
+
+def write_refs(path, var, aux_attr=True, time=TIME):
+    # inline reference set of one variable with latitude / longitude on (time, lat, lon),
+    # the layout of the interpolated *_pc.json files
+    shape = (len(time), len(LAT), len(LON))
+    latitude, longitude = np.broadcast_arrays(LAT[None, :, None], LON[None, None, :], np.zeros(shape))[:2]
+    values = np.random.default_rng(len(var)).normal(size=shape).astype("f4")
+    ds = xr.Dataset({var: (("time", "lat", "lon"), values)},
+                    coords={"time": time, "lat": LAT, "lon": LON,
+                            "latitude": (("time", "lat", "lon"), latitude),
+                            "longitude": (("time", "lat", "lon"), longitude)})
+    store = {}
+    ds.to_zarr(store, consolidated=False)
+    refs = {}
+    for key, value in store.items():
+        value = bytes(value)
+        if key.rsplit("/", 1)[-1] in (".zgroup", ".zattrs", ".zarray"):
+            meta = json.loads(value)
+            if not aux_attr:
+                meta.pop("coordinates", None)
+            refs[key] = json.dumps(meta)
+        else:
+            refs[key] = "base64:" + base64.b64encode(value).decode()
+    with open(path, "w") as outfile:
+        json.dump({"version": 1, "refs": refs}, outfile)
+    return ds
+
+
+def open_refs(path):
+    return xr.open_zarr("reference::" + path, consolidated=True)
+
+
+@pytest.mark.parametrize("aux_attr", [True, False])
+def test_auxiliary_coordinates(tmp_path, aux_attr):
+    paths = [str(tmp_path / f"{var}.json") for var in ("2t", "lcc")]
+    expected = xr.merge([write_refs(path, var, aux_attr) for path, var in zip(paths, ("2t", "lcc"))])
+    outfile = merge_references(paths, str(tmp_path / "merged.json"))
+    merged = open_refs(outfile)
+    if not aux_attr:  # without the attribute xarray opens them as variables
+        merged = merged.set_coords(["latitude", "longitude"])
+    assert sorted(merged.data_vars) == ["2t", "lcc"]
+    xr.testing.assert_equal(merged.load(), expected)
+
+
+def test_add_to_single_file(tmp_path):
+    # latitude is only known to be shared once a second file has it as well
+    first, second = str(tmp_path / "2t.json"), str(tmp_path / "lcc.json")
+    write_refs(first, "2t", aux_attr=False)
+    write_refs(second, "lcc", aux_attr=False)
+    outfile = merge_references([first], str(tmp_path / "merged.json"))
+    add_references([second], outfile)
+    with open(outfile) as infile:
+        sources = json.load(infile)["sources"]
+    assert sources[first]["variables"] == ["2t"]
+    assert sources[second]["variables"] == ["lcc"]
+    assert sorted(open_refs(outfile).data_vars) == ["2t", "latitude", "lcc", "longitude"]
+
+
+def test_extend_time(tmp_path):
+    # the per-variable files are rewritten with a longer time axis and merged again
+    paths = [str(tmp_path / f"{var}.json") for var in ("2t", "lcc")]
+    outfile = str(tmp_path / "merged.json")
+    for path, var in zip(paths, ("2t", "lcc")):
+        write_refs(path, var)
+    merge_references(paths, outfile)
+    time = pd.date_range(TIME[0], periods=2 * len(TIME), freq="h")
+    expected = xr.merge([write_refs(path, var, time=time) for path, var in zip(paths, ("2t", "lcc"))])
+    merge_references(paths, outfile)
+    xr.testing.assert_equal(open_refs(outfile).load(), expected)
+
+
+def test_duplicate_variable(tmp_path):
+    paths = [str(tmp_path / f"{name}.json") for name in ("a", "b", "c")]
+    write_refs(paths[0], "2t")
+    write_refs(paths[1], "2t")
+    write_refs(paths[2], "lcc")
+    with pytest.raises(ValueError, match="already in"):
+        merge_references(paths, str(tmp_path / "merged.json"))
+
+
+def test_same_variable_twice(tmp_path):
+    paths = [str(tmp_path / f"{name}.json") for name in ("a", "b")]
+    write_refs(paths[0], "2t")
+    write_refs(paths[1], "2t")
+    with pytest.raises(ValueError, match="no variables"):
+        merge_references(paths, str(tmp_path / "merged.json"))
@@ -0,0 +1,274 @@
+"""
+I/O benchmark of every source in the catalog tree
+
+For each source: time to open, memory allocated while opening (metadata), latency of a
+single chunk, throughput of reading one full time step and of a time mean over a few steps.
+Results are written as JSON, `--compare` prints the ratios to an earlier report.
+
+Sources are opened like intake_xarray does (zarr with storage_options, netcdf lists with
+combine/chunks), so neither intake nor the plugins have to be installed.
+`--synthetic DIR` writes small local stand-ins with the layouts of the catalog (reference-backed
+IFS GRIB, ICON zarr at three resolutions, FESOM NetCDF lists) and benchmarks those instead.
+
+    python benchmark_catalog.py ../catalog.yaml --match "ICON/*" --out icon.json
+    python benchmark_catalog.py --synthetic /tmp/standin --out synthetic.json
+"""
+import os
+import sys
+import json
+import time
+import base64
+import fnmatch
+import argparse
+import platform
+import tracemalloc
+
+import yaml
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def walk(catalog, prefix=""):
+    # (name, source) of all data sources, nested yaml_file_cat catalogs are followed
+    with open(catalog) as infile:
+        cat = yaml.safe_load(infile)
+    catdir = os.path.dirname(os.path.abspath(catalog))
+    for name, source in cat.get("sources", {}).items():
+        path = prefix + name
+        if source.get("driver") == "yaml_file_cat":
+            sub = source["args"]["path"].replace("{{CATALOG_DIR}}", catdir)
+            if os.path.exists(sub):
+                yield from walk(sub, path + "/")
+            else:
+                yield path, {"error": f"catalog {sub} not found"}
+        else:
+            yield path, source
+
+
+def open_source(source):
+    args = dict(source.get("args", {}))
+    urlpath = args.pop("urlpath")
+    if source["driver"] == "zarr":
+        kwargs = {key: args[key] for key in ("consolidated", "storage_options") if key in args}
+        if isinstance(urlpath, list):
+            return xr.open_mfdataset(urlpath, engine="zarr", combine=args.get("combine", "by_coords"),
+                                     compat=args.get("compat", "no_conflicts"), backend_kwargs=kwargs)
+        return xr.open_zarr(urlpath, **kwargs)
+    if source["driver"] == "netcdf":
+        if isinstance(urlpath, list) or "*" in urlpath:
+            return xr.open_mfdataset(urlpath, chunks=args.get("chunks", {}),
+                                     combine=args.get("combine", "by_coords"), parallel=False)
+        return xr.open_dataset(urlpath, chunks=args.get("chunks", {}))
+    raise ValueError(f"driver {source['driver']} is not supported")
+
+
+def timed(func):
+    t0, c0 = time.perf_counter(), time.process_time()
+    result = func()
+    return result, time.perf_counter() - t0, time.process_time() - c0
+
+
+def pick_variable(ds, dim="time"):
+    # the largest variable along time
+    candidates = [var for var in ds.data_vars.values() if dim in var.dims and var.dtype.kind in "fiu"]
+    return max(candidates, key=lambda var: var.size) if candidates else None
+
+
+def benchmark(ds_open, nsteps=4):
+    result = {}
+    tracemalloc.start()
+    ds, result["open_s"], _ = timed(ds_open)
+    result["metadata_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    result["variables"] = len(ds.data_vars)
+
+    var = pick_variable(ds)
+    if var is None:
+        return result
+    result["variable"] = var.name
+    result["shape"] = list(var.shape)
+    if var.chunks:
+        first = var.data.blocks[(0,) * var.ndim]
+        chunk, result["chunk_s"], _ = timed(lambda: first.compute())
+        result["chunk_mb"] = chunk.nbytes / 2**20
+
+    step = var.isel(time=0)
+    values, wall, cpu = timed(lambda: step.values)
+    result.update(step_s=wall, step_cpu_s=cpu, step_mb_s=values.nbytes / 2**20 / wall)
+
+    steps = var.isel(time=slice(0, nsteps))
+    _, wall, cpu = timed(lambda: steps.mean("time").values)
+    result.update(mean_steps=steps.sizes["time"], mean_s=wall, mean_cpu_s=cpu,
+                  mean_mb_s=steps.nbytes / 2**20 / wall)
+    return result
+
+
+def run(catalog, match=("*",), nsteps=4):
+    results = {}
+    for path, source in walk(catalog):
+        if not any(fnmatch.fnmatch(path, pattern) for pattern in match):
+            continue
+        if "error" in source:
+            results[path] = source
+            continue
+        try:
+            results[path] = {"driver": source["driver"], **benchmark(lambda: open_source(source), nsteps)}
+        except Exception as e:  # a broken source must not stop the other benchmarks
+            results[path] = {"driver": source.get("driver"), "error": f"{type(e).__name__}: {e}"}
+        print(path, json.dumps(results[path]), flush=True)
+    return results
+
+
+def report(results, catalog, args):
+    import dask
+    import zarr
+    return {
+        "catalog": os.path.abspath(catalog),
+        "date": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "python": sys.version.split()[0],
+        "versions": {mod.__name__: mod.__version__ for mod in (np, xr, dask, zarr)},
+        "args": vars(args),
+        "sources": results,
+    }
+
+
+def compare(new, old, keys=("open_s", "metadata_mb", "chunk_s", "step_s", "mean_s")):
+    # ratio new / old per source and metric, < 1 is faster (or smaller)
+    print(f"{'source':50s}" + "".join(f"{key:>12s}" for key in keys))
+    for path, result in new["sources"].items():
+        before = old["sources"].get(path, {})
+        ratios = [result[key] / before[key] if before.get(key) and key in result else np.nan for key in keys]
+        print(f"{path:50s}" + "".join(f"{r:12.2f}" for r in ratios))
+
+
+# --- synthetic stand-ins -------------------------------------------------------------------------
+
+def _source(driver, urlpath, **args):
+    return {"driver": driver, "args": {"urlpath": urlpath, **args}}
+
+
+def _dump(filename, sources):
+    with open(filename, "w") as outfile:
+        yaml.dump({"sources": sources}, outfile, sort_keys=False)
+
+
+def _catalogs(filename, entries):
+    _dump(filename, {name: {"driver": "yaml_file_cat", "args": {"path": "{{CATALOG_DIR}}/" + path}}
+                     for name, path in entries.items()})
+
+
+def synthetic_ifs(folder, ntime, npoints, nlevel=4):
+    # raw float32 "messages" in one file, indexed by a gribscan-like reference JSON, one chunk per (time, level)
+    rng = np.random.default_rng(0)
+    refs = {".zgroup": json.dumps({"zarr_format": 2})}
+
+    def array(name, dims, shape, chunks, dtype, attrs=None):
+        refs[f"{name}/.zarray"] = json.dumps({"shape": shape, "chunks": chunks, "dtype": dtype, "compressor": None,
+                                              "filters": None, "fill_value": None, "order": "C", "zarr_format": 2})
+        refs[f"{name}/.zattrs"] = json.dumps({"_ARRAY_DIMENSIONS": dims, **(attrs or {})})
+
+    def inline(name, values):
+        refs[f"{name}/0"] = "base64:" + base64.b64encode(values.tobytes()).decode()
+
+    array("time", ["time"], [ntime], [ntime], "<i8", {"units": "hours since 2020-01-20", "calendar": "standard"})
+    inline("time", np.arange(ntime, dtype="<i8"))
+    array("level", ["level"], [nlevel], [nlevel], "<f8")
+    inline("level", np.linspace(1000, 200, nlevel))
+    for coord, values in (("lat", np.rad2deg(np.arcsin(rng.uniform(-1, 1, npoints)))),
+                          ("lon", rng.uniform(0, 360, npoints))):
+        array(coord, ["value"], [npoints], [npoints], "<f8")
+        inline(coord, values)
+    variables = {"2t": None, "sst": None, "t": nlevel, "q": nlevel}
+    for var, nlev in variables.items():
+        if nlev:
+            array(var, ["time", "level", "value"], [ntime, nlev, npoints], [1, 1, npoints], "<f4")
+        else:
+            array(var, ["time", "value"], [ntime, npoints], [1, npoints], "<f4")
+    offset = 0
+    with open(os.path.join(folder, "ifs.grib"), "wb") as grib:
+        for it in range(ntime):
+            for var, nlev in variables.items():
+                for il in range(nlev or 1):
+                    message = rng.normal(280, 10, npoints).astype("<f4").tobytes()
+                    grib.write(message)
+                    key = f"{var}/{it}.{il}.0" if nlev else f"{var}/{it}.0"
+                    refs[key] = ["{{u}}", offset, len(message)]
+                    offset += len(message)
+    # one reference file for the surface, one for the pressure level variables, like ICMGG_atm2d and ICMU_atm3d
+    sources = {}
+    for name, kind in (("ICMGG_atm2d", "atm2d"), ("ICMU_atm3d", "atm3d")):
+        skip = [var for var, nlev in variables.items() if bool(nlev) != (kind == "atm3d")]
+        subset = {key: value for key, value in refs.items() if key.split("/")[0] not in skip}
+        with open(os.path.join(folder, f"{kind}.json"), "w") as outfile:
+            json.dump({"version": 1, "templates": {"u": os.path.join(folder, "ifs.grib")}, "refs": subset}, outfile)
+        sources[name] = _source("zarr", "reference::" + os.path.join(folder, f"{kind}.json"), consolidated=False)
+    _dump(os.path.join(folder, "ifs.yaml"), sources)
+
+
+def synthetic_icon(folder, ntime, resolutions):
+    rng = np.random.default_rng(1)
+    sources = {}
+    for name, ncells in resolutions.items():
+        ds = xr.Dataset({var: (("time", "ncells"), rng.normal(size=(ntime, ncells)).astype("f4"))
+                         for var in ("ts", "pr", "clivi")},
+                        coords={"time": pd.date_range("2020-01-20", periods=ntime, freq="30min")})
+        store = os.path.join(folder, f"{name}_2d_ml.zarr")
+        ds.chunk({"time": 4}).to_zarr(store, mode="w", consolidated=True)
+        sources[f"atm_2d_ml_{name}"] = _source("zarr", store, consolidated=True)
+    _dump(os.path.join(folder, "icon.yaml"), sources)
+
+
+def synthetic_fesom(folder, ntime, nnodes, nfiles=3):
+    rng = np.random.default_rng(2)
+    paths = []
+    for i in range(nfiles):
+        ds = xr.Dataset({var: (("time", "nod2"), rng.normal(size=(ntime, nnodes)).astype("f4"))
+                         for var in ("sst", "sss", "ssh")},
+                        coords={"time": pd.date_range(pd.Timestamp("2020-01-20") + pd.Timedelta(days=i),
+                                                     periods=ntime, freq="h")})
+        paths.append(os.path.join(folder, f"fesom_2d_{i}.nc"))
+        ds.to_netcdf(paths[-1])
+    grid = xr.Dataset({"grid_center_lat": ("ncells", rng.uniform(-90, 90, nnodes)),
+                       "grid_center_lon": ("ncells", rng.uniform(-180, 180, nnodes))})
+    grid.to_netcdf(os.path.join(folder, "fesom_grid.nc"))
+    _dump(os.path.join(folder, "fesom.yaml"), {
+        "original_2d": _source("netcdf", paths, chunks={"time": 1}),
+        "node_grid": _source("netcdf", os.path.join(folder, "fesom_grid.nc")),
+    })
+
+
+def synthetic_catalog(folder, ntime=24, npoints=20000):
+    # the catalog tree with small stand-ins of every kind of source, returns the top level catalog
+    os.makedirs(folder, exist_ok=True)
+    synthetic_ifs(folder, ntime, npoints)
+    synthetic_icon(folder, ntime, {"R02B09": npoints, "R02B08": npoints // 4, "R02B06": npoints // 64})
+    synthetic_fesom(folder, ntime, npoints)
+    _catalogs(os.path.join(folder, "catalog.yaml"), {"IFS": "ifs.yaml", "ICON": "icon.yaml", "FESOM": "fesom.yaml"})
+    return os.path.join(folder, "catalog.yaml")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("catalog", nargs="?", default=os.path.join(os.path.dirname(__file__), "..", "catalog.yaml"))
+    parser.add_argument("--match", nargs="*", default=["*"], help="glob patterns of source paths, e.g. 'IFS/*'")
+    parser.add_argument("--nsteps", type=int, default=4, help="time steps in the time mean")
+    parser.add_argument("--out", default=None, help="JSON report")
+    parser.add_argument("--compare", default=None, help="earlier JSON report")
+    parser.add_argument("--synthetic", default=None, metavar="DIR",
+                        help="write and benchmark local stand-ins in DIR instead of the catalog")
+    args = parser.parse_args()
+
+    catalog = synthetic_catalog(args.synthetic) if args.synthetic else args.catalog
+    out = report(run(catalog, args.match, args.nsteps), catalog, args)
+    if args.out:
+        with open(args.out, "w") as outfile:
+            json.dump(out, outfile, indent=1)
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(out, json.load(infile))
+
+
+if __name__ == "__main__":
+    main()
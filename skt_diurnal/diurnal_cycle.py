@@ -0,0 +1,240 @@
+## Streaming engine for the mean diurnal cycle of clear-sky SKT
+## Walks the time axis once in chunks and accumulates all hourly bins at once
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask
+import datetime as dt
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from region import RegionSubset
+
+from tracing import span
+
+## gribscan references of the IFS surface fields
+IFS_REFERENCES = {
+  'tco1279-orca025': "/work/bm1235/a270046/cycle2-sync/tco1279-orca025/nemo_deep/ICMGGc2/json.dir/atm2d_v0.json",
+  'tco3999-ng5': '/work/bm1235/a270046/cycle2-sync/tco3999-ng5/ICMGGc2/json.dir/atm2d.json',
+  'tco2559-ng5': '/work/bm1235/a270046/cycle2-sync/tco2559-ng5/ICMGGall_update/json.dir/atm2d.json',
+}
+
+## ICON experiments: intake-esm catalog, grid, output frequency and hours between slots
+ICON_EXPERIMENTS = {
+  'ngc2009': dict(catalog_file="/home/k/k203123/NextGEMS_Cycle2.git/experiments/ngc2009/scripts/ngc2009.json",
+                  grid_path="/pool/data/ICON/grids/public/mpim/0015/icon_grid_0015_R02B09_G.nc",
+                  frequency='30minute', freq=1),
+  'ngc2012': dict(catalog_file="/home/k/k203123/NextGEMS_Cycle2.git/experiments/ngc2012/scripts/ngc2012.json",
+                  grid_path="/pool/data/ICON/grids/public/mpim/0033/icon_grid_0033_R02B08_G.nc",
+                  frequency='3hour', freq=3),
+}
+
+## region of the output grid, (lat_min, lat_max, lon_min, lon_max)
+BBOX = (-81, 81, -81, 81)
+
+## per worker state, set by init_worker
+_fields = None
+_region = None
+_clear_sky = None
+
+
+def open_reference(datazarr, variables):
+  ## open gribscan reference and return the requested variables
+  import gribscan  # registers the GRIB codec
+  data = xr.open_zarr("reference::"+datazarr, consolidated=False)
+  return {v: data[v] for v in variables}
+
+
+def ifs_LALO(data):
+  ## grid coordinates of a gribscan dataset, longitudes in -180..180
+  model_lon = np.where(data.lon.values>180, data.lon.values-360, data.lon.values)
+  return data.lat.values, model_lon
+
+
+def clear_sky_ifs(values, tcc_min=0.3):
+  ## skt in Celsius and clear sky mask from total cloud cover
+  return values['skt'] - 273.16, values['tcc'] <= tcc_min
+
+
+def load_var(exp,cvar=None,realm='atm',frequency=None,load_LALO=False):
+  ## Load ICON variable from the experiment catalog, or the grid coordinates
+  t0=time.time()
+  cfg = ICON_EXPERIMENTS[exp]
+  frequency = frequency or cfg['frequency']
+  
+  if load_LALO:
+    ## read only the cell centres, not the whole grid file
+    from netCDF4 import Dataset
+    with Dataset(cfg['grid_path']) as grid:
+      grid.set_auto_mask(False)
+      model_lon = grid.variables['clon'][:]*180./np.pi
+      model_lat = grid.variables['clat'][:]*180./np.pi
+      return model_lat,model_lon
+    
+  import intake
+  cat = intake.open_esm_datastore(cfg['catalog_file'])
+  final_query = cat.search(realm=realm, frequency=frequency, variable_id=cvar)
+  dataset_dict = final_query.to_dataset_dict(
+      cdf_kwargs={
+          "chunks": dict(
+              time=1,
+          )
+      }
+  )
+  keys = list(dataset_dict.keys())
+  print(keys)
+  data = dataset_dict[keys[0]]
+  print(f"Loaded {exp} {cvar} in {time.time()-t0:.1f} sec") 
+ 
+  return data
+
+
+def icon_grid_uuid(exp):
+  ## grid id from the global attributes only
+  from netCDF4 import Dataset
+  with Dataset(ICON_EXPERIMENTS[exp]['grid_path']) as grid:
+    return grid.getncattr('uuidOfHGrid')
+
+
+def icon_region(exp, cachedir, bbox=BBOX):
+  ## cells of exp inside bbox, the grid coordinates are only read once per grid
+  return RegionSubset.cached(lambda: load_var(exp, load_LALO=True), bbox, icon_grid_uuid(exp), cachedir)
+
+
+def open_icon(exp, variables):
+  ## open ICON variables, one catalog query each
+  return {v: load_var(exp, v)[v] for v in variables}
+
+
+def clear_sky_icon(values, tcw_min=0.005):
+  ## ts in Celsius and clear sky mask from total cloud liquid and ice water
+  return values['ts'] - 273.16, values['cllvi'] + values['clivi'] <= tcw_min
+
+
+def month_slots(YM, freq=1):
+  ## all slots of a month used for the diurnal cycle and their hour of day
+  ndays = (YM.replace(month = YM.month % 12 +1, day = 1)-dt.timedelta(days=1)).day
+  slots = [YM+dt.timedelta(days=iday)+dt.timedelta(hours=ih)
+           for iday in range(ndays) for ih in range(0,24,freq)]
+  return pd.DatetimeIndex(slots)
+
+
+def time_indices(time, slots):
+  ## position of the slots on the time axis of the data
+  itimes = pd.Index(time).get_indexer(slots)
+  if (itimes < 0).any():
+    raise KeyError(f"missing time slots: {list(slots[itimes < 0])}")
+  return itimes
+
+
+def init_worker(opener, region, clear_sky, forked=False):
+  global _fields, _region, _clear_sky
+  if forked:
+    # a thread pool inherited from the parent process may deadlock
+    dask.config.set(scheduler='synchronous')
+  with span('open_fields'):
+    _fields = opener()
+  _region = region if isinstance(region, RegionSubset) else RegionSubset(region)
+  _clear_sky = clear_sky
+
+
+def accumulate(itimes, hours, chunksize=24, nhours=24):
+  ## sums and counts of clear sky values per hour of day for the given time indices
+  ## all fields of a chunk of timesteps are read together, only the cell ranges of the region
+  ## a worker holds nhours*npp*6 bytes of sums and counts (npp cells in the region) and about
+  ## chunksize*npp*4 bytes per field of the chunk being read, plus the bridged gaps of the spans
+  sums = np.zeros((nhours, len(_region)), 'f4')
+  counts = np.zeros((nhours, len(_region)), 'u2')
+  for i0 in range(0, len(itimes), chunksize):
+    sel = itimes[i0:i0+chunksize]
+    with span('read', steps=len(sel)) as sp:
+      loaded = dask.compute(*[_region.select(f.isel(time=sel)).data for f in _fields.values()])
+      sp.add(bytes_read=sum(v.nbytes for v in loaded), elements=sum(v.size for v in loaded))
+    with span('gather', steps=len(sel)) as sp:
+      values = {name: _region(v) for name, v in zip(_fields, loaded)}
+      sp.add(elements=sum(v.size for v in values.values()))
+    with span('accumulate', steps=len(sel)) as sp:
+      value, ok = _clear_sky(values)
+      hrs = hours[i0:i0+chunksize]
+      for ih in np.unique(hrs):
+        m = hrs == ih
+        sums[ih] += np.where(ok[m], value[m], 0).sum(axis=0)
+        counts[ih] += ok[m].sum(axis=0, dtype='u2')
+      sp.add(elements=value.size)
+  return sums, counts
+
+
+def open_pool(opener, region, clear_sky, workers=4):
+  ## process pool with the fields opened once per worker, can be shared across months
+  ## opener and clear_sky must be picklable, opener() returns a dict of (time, cell) DataArrays
+  ## region is a RegionSubset or an array of cell indices
+  return ProcessPoolExecutor(workers, initializer=init_worker, initargs=(opener, region, clear_sky, True))
+
+
+class PartialSums:
+  ## sums and counts of the accumulate futures of one month, every partial result is added as
+  ## soon as its worker is done and then released, so only one (nhours, npp) sum and count
+  ## array is kept per month however many workers contribute
+
+  def __init__(self, futures):
+    self.sums = self.counts = self.error = None
+    self.remaining = len(futures)
+    self.lock = threading.Lock()
+    self.done = threading.Event()
+    if not futures:
+      self.done.set()
+    for future in futures:
+      future.add_done_callback(self.add)
+
+  def add(self, future):
+    with self.lock:
+      try:
+        psums, pcounts = future.result()
+        if self.sums is None:
+          self.sums, self.counts = psums, pcounts
+        else:
+          self.sums += psums
+          self.counts += pcounts
+      except BaseException as e:
+        self.error = e
+      self.remaining -= 1
+      if self.remaining == 0:
+        self.done.set()
+
+  def result(self):
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.sums, self.counts
+
+
+def submit_sums(pool, itimes, hours, workers=4, chunksize=24, nhours=24):
+  ## Split the time axis into one contiguous span per worker, each worker reads its span
+  ## in chunks of `chunksize` timesteps
+  spans = [s for s in np.array_split(np.arange(len(itimes)), workers) if len(s) > 0]
+  return PartialSums([pool.submit(accumulate, itimes[s], hours[s], chunksize, nhours) for s in spans])
+
+
+def diurnal_sums(opener, region, itimes, hours, clear_sky, workers=4, chunksize=24, nhours=24):
+  ## returns sums, counts and number of slots per hour of day
+  nslots = np.bincount(hours, minlength=nhours)
+  if workers <= 1:
+    init_worker(opener, region, clear_sky)
+    sums, counts = accumulate(itimes, hours, chunksize, nhours)
+    return sums, counts, nslots
+
+  with open_pool(opener, region, clear_sky, workers) as pool:
+    partial = submit_sums(pool, itimes, hours, workers, chunksize, nhours)
+    with span('merge_sums', workers=workers):
+      sums, counts = partial.result()
+  return sums, counts, nslots
+
+
+def diurnal_means(sums, counts, nslots, zfill):
+  ## mean clear sky value and fraction of valid slots per hour of day
+  with np.errstate(invalid='ignore', divide='ignore'):
+    zAVG = np.where(counts>0, sums / counts, zfill)
+    zVAL = np.where(counts>0, counts / np.maximum(nslots, 1)[:, np.newaxis], 0)
+  return zAVG, zVAL
@@ -0,0 +1,211 @@
+## Writers of the hourly LST / FVALID fields of the diurnal cycle output
+## One writer stays open for the whole run. Each field is split into chunks which are rounded
+## to the least significant digit of the variable (same as netCDF4's least_significant_digit),
+## shuffled and zlib compressed in a thread pool, while the previous hour is being remapped.
+## The compressed chunks are stored directly, as HDF5 chunks of the NetCDF4 file or zarr chunks.
+
+import os
+import zlib
+import shutil
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import span
+
+ZFILL = -999
+## hours which are never processed keep the netCDF default fill of NSLOT in both formats
+NSLOT_FILL = np.float32(9.969209968386869e36)
+COMPLEVEL = 6
+## chunks of one hour, the 3201x3201 output grid is split into 4x4 chunks
+CHUNKS = (801, 801)
+
+## long_name, units and least significant decimal digit of the hourly fields
+FIELDS = {
+  'LST': ('LST', 'Celsius', 2),
+  'FVALID': ('fraction of valid pixels in average', '0-1', 3),
+}
+
+
+def bitround(values, digits):
+  ## netCDF4 least_significant_digit quantization: round to the power of two
+  ## which is at least as fine as 10**-digits, e.g. 1/128 for 2 digits
+  ## scaling by a power of two is exact, so float32 input is rounded in float32
+  values = np.asarray(values)
+  dtype = np.result_type(values.dtype, np.float32)
+  scale = dtype.type(2.**np.ceil(np.log2(10.**digits)))
+  out = np.multiply(values, scale, dtype=dtype)
+  np.rint(out, out=out)
+  out /= scale
+  return out
+
+
+def encode_chunk(field, ys, xs, digits, chunks=CHUNKS, level=COMPLEVEL):
+  ## rounded, byte shuffled and zlib compressed chunk of field[ys, xs], padded to full chunk size
+  ## like the HDF5 shuffle and deflate filters or zarr's Shuffle and Zlib codecs
+  with span('compress', digits=digits) as sp:
+    block = np.full(chunks, ZFILL, 'f4')
+    block[:ys.stop-ys.start, :xs.stop-xs.start] = bitround(field[ys, xs], digits)
+    shuffled = np.ascontiguousarray(block.view('u1').reshape(-1, 4).T)
+    data = zlib.compress(shuffled, level)
+    sp.add(bytes_read=block.nbytes, bytes_written=len(data), elements=block.size)
+  return data
+
+
+def chunk_slices(shape, chunks=CHUNKS):
+  ## (chunk index, slices) of all chunks of a 2D field
+  for iy, y0 in enumerate(range(0, shape[0], chunks[0])):
+    for ix, x0 in enumerate(range(0, shape[1], chunks[1])):
+      yield (iy, ix), (slice(y0, min(y0+chunks[0], shape[0])), slice(x0, min(x0+chunks[1], shape[1])))
+
+
+def month_hours(months):
+  ## hours since the first month of the 24 hourly steps of each month
+  return np.concatenate([np.arange(24) + int((YM - months[0]) / dt.timedelta(hours=1)) for YM in months])
+
+
+class LSTWriter:
+  ## write(it, fields, nslot) queues the compression of one time step and stores the chunks
+  ## of the previous one, close() stores the rest
+
+  def __init__(self, fout, lat_reg, lon_reg, months, workers=4, chunks=CHUNKS):
+    self.fout = fout
+    self.shape = lat_reg.shape
+    self.chunks = tuple(min(c, n) for c, n in zip(chunks, self.shape))
+    self.create(lat_reg, lon_reg, months)
+    self.pool = ThreadPoolExecutor(workers)
+    self.pending = []
+
+  def write(self, it, fields, nslot):
+    ## fields: {'LST': (lat, lon) array, 'FVALID': (lat, lon) array}, must not be changed afterwards
+    pending = [((name, it) + index, self.pool.submit(encode_chunk, field, ys, xs, FIELDS[name][2], self.chunks))
+               for name, field in fields.items()
+               for index, (ys, xs) in chunk_slices(self.shape, self.chunks)]
+    self.flush()
+    self.pending = pending
+    self.store_nslot(it, nslot)
+
+  def flush(self):
+    with span('store_chunks') as sp:
+      for key, future in self.pending:
+        data = future.result()
+        self.store_chunk(*key, data)
+        sp.add(bytes_written=len(data))
+    self.pending = []
+
+  def close(self):
+    self.flush()
+    self.pool.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class NetCDFWriter(LSTWriter):
+  ## same variables and attributes as the NetCDF4 files written with netCDF4 before,
+  ## the chunks are written with h5py without passing through the HDF5 filter pipeline
+
+  def create(self, lat_reg, lon_reg, months):
+    from netCDF4 import Dataset
+    import h5py
+    if os.path.isfile(self.fout):
+      os.remove(self.fout)
+    with Dataset(self.fout, 'w', format='NETCDF4') as nc:
+      nc.createDimension('lat', len(lat_reg))
+      nc.createDimension('lon', len(lon_reg[0]))
+      nc.createDimension('time', 24*len(months))
+
+      cvar = nc.createVariable('lat', 'f4', ['lat',])
+      cvar.units = "degrees_north"
+      cvar.long_name = "latitude"
+      cvar.standard_name = "latitude"
+      cvar.axis = "Y"
+      cvar[:] = lat_reg[:, 0]
+
+      cvar = nc.createVariable('lon', 'f4', ['lon',])
+      cvar.units = "degrees_east"
+      cvar.long_name = "longitude"
+      cvar.standard_name = "longitude"
+      cvar.axis = "X"
+      cvar[:] = lon_reg[0, :]
+
+      cvar = nc.createVariable('time', 'i4', ['time',])
+      cvar.units = f"hours since {months[0].strftime('%Y-%m-%d')}T00:00:00"
+      cvar.long_name = "time"
+      cvar.standard_name = "time"
+      cvar.axis = "T"
+      cvar.calendar = "standard"
+      cvar[:] = month_hours(months)
+
+      for name, (long_name, units, digits) in FIELDS.items():
+        cvar = nc.createVariable(name, 'f4', ('time', 'lat', 'lon'),
+                                 fill_value=ZFILL, zlib=True, complevel=COMPLEVEL, shuffle=True,
+                                 least_significant_digit=digits, chunksizes=(1,) + self.chunks)
+        cvar.long_name = long_name
+        cvar.units = units
+
+      cvar = nc.createVariable('NSLOT', 'f4', ('time',), fill_value=NSLOT_FILL)
+      cvar.long_name = 'total number of slots processed'
+      cvar.units = '-'
+    self.h5 = h5py.File(self.fout, 'r+')
+
+  def store_chunk(self, name, it, iy, ix, data):
+    self.h5[name].id.write_direct_chunk((it, iy*self.chunks[0], ix*self.chunks[1]), data)
+
+  def store_nslot(self, it, nslot):
+    self.h5['NSLOT'][it] = nslot
+
+  def close(self):
+    super().close()
+    self.h5.close()
+
+
+class ZarrWriter(LSTWriter):
+  ## zarr store with the same variables and attributes as the NetCDF4 files
+
+  def create(self, lat_reg, lon_reg, months):
+    import zarr
+    from numcodecs import Zlib, Shuffle
+    times = pd.DatetimeIndex([YM + dt.timedelta(hours=ih) for YM in months for ih in range(24)])
+    shape = (len(times),) + self.shape
+    ## lazy template, only the metadata is written here
+    empty = da.full(shape, ZFILL, dtype='f4', chunks=(1,) + self.chunks)
+    ds = xr.Dataset({
+      name: (('time', 'lat', 'lon'), empty,
+             {'long_name': long_name, 'units': units, 'least_significant_digit': digits})
+      for name, (long_name, units, digits) in FIELDS.items()
+    }, coords={
+      'time': ('time', times, {'long_name': 'time', 'standard_name': 'time', 'axis': 'T'}),
+      'lat': ('lat', lat_reg[:, 0].astype('f4'),
+              {'units': 'degrees_north', 'long_name': 'latitude', 'standard_name': 'latitude', 'axis': 'Y'}),
+      'lon': ('lon', lon_reg[0, :].astype('f4'),
+              {'units': 'degrees_east', 'long_name': 'longitude', 'standard_name': 'longitude', 'axis': 'X'}),
+    })
+    ds['NSLOT'] = ('time', np.full(len(times), NSLOT_FILL), {'long_name': 'total number of slots processed', 'units': '-'})
+    encoding = {name: {'_FillValue': ZFILL, 'chunks': (1,) + self.chunks,
+                       'compressor': Zlib(COMPLEVEL), 'filters': [Shuffle(4)]} for name in FIELDS}
+    encoding['NSLOT'] = {'_FillValue': NSLOT_FILL}
+    encoding['time'] = {'units': f"hours since {months[0].strftime('%Y-%m-%d')}T00:00:00",
+                        'calendar': 'standard', 'dtype': 'i4'}
+    if os.path.isdir(self.fout):
+      shutil.rmtree(self.fout)
+    ds.to_zarr(self.fout, mode='w', compute=False, encoding=encoding)
+    self.group = zarr.open_group(self.fout, mode='r+')
+
+  def store_chunk(self, name, it, iy, ix, data):
+    self.group.store[f"{name}/{it}.{iy}.{ix}"] = data
+
+  def store_nslot(self, it, nslot):
+    self.group['NSLOT'][it] = nslot
+
+
+def open_writer(fout, lat_reg, lon_reg, months, workers=4, chunks=CHUNKS):
+  ## zarr store for *.zarr, else NetCDF4
+  cls = ZarrWriter if fout.rstrip('/').endswith('.zarr') else NetCDFWriter
+  return cls(fout, lat_reg, lon_reg, months, workers, chunks)
@@ -0,0 +1,120 @@
+## Batch driver for the mean diurnal cycle of SKT from IFS and ICON
+## Processes many months in one job: data, grid, region and remap are set up once,
+## months are scheduled onto one worker pool and written to a single zarr store (or NetCDF4 file)
+## usage: python3 -u process_batch.py resol YYYYMM[-YYYYMM] [YYYYMM[-YYYYMM] ...]
+
+import xarray as xr
+import numpy as np
+import datetime as dt
+import time
+import argparse
+import functools
+from collections import deque
+
+from remap import NearestRemap
+from lst_output import open_writer
+from region import RegionSubset
+from diurnal_cycle import (IFS_REFERENCES, ICON_EXPERIMENTS, BBOX, open_reference, ifs_LALO, open_icon,
+                           icon_region, clear_sky_ifs, clear_sky_icon, month_slots, time_indices,
+                           open_pool, submit_sums, diurnal_means)
+import tracing
+from tracing import span
+
+DFOUT="/scratch/b/b381666/SKT_DIAG/"
+DREMAP="/scratch/b/b381666/SKT_DIAG/remap/"
+ZFILL=-999
+tcc_min = 0.3
+tcw_min = 0.005
+
+
+def parse_months(specs):
+  ## YYYYMM or inclusive ranges YYYYMM-YYYYMM
+  months = []
+  for spec in specs:
+    first, _, last = spec.partition('-')
+    YM = dt.datetime.strptime(first, "%Y%m")
+    end = dt.datetime.strptime(last or first, "%Y%m")
+    while YM <= end:
+      months.append(YM)
+      YM = YM.replace(year=YM.year + YM.month // 12, month=YM.month % 12 + 1)
+  return months
+
+
+def setup_model(resol):
+  ## opener, clear sky test, hours between slots, time axis and region of a model
+  if resol in IFS_REFERENCES:
+    datazarr = IFS_REFERENCES[resol]
+    data = xr.open_zarr("reference::"+datazarr, consolidated=False)
+    region = RegionSubset.cached(functools.partial(ifs_LALO, data), BBOX, resol, DREMAP)
+    opener = functools.partial(open_reference, datazarr, ('skt', 'tcc'))
+    return (opener, functools.partial(clear_sky_ifs, tcc_min=tcc_min), 1,
+            data.time.values, region)
+  opener = functools.partial(open_icon, resol, ('ts', 'cllvi', 'clivi'))
+  return (opener, functools.partial(clear_sky_icon, tcw_min=tcw_min), ICON_EXPERIMENTS[resol]['freq'],
+          opener()['ts'].time.values, icon_region(resol, DREMAP))
+
+
+def write_month(writer, imonth, YM, slots, partial, remap):
+  t0M = time.time()
+  month = YM.strftime('%Y%m')
+  with span('merge_sums', month=month):
+    sums, counts = partial.result()
+  nslots = np.bincount(slots.hour.values, minlength=24)
+  zAVG, zVAL = diurnal_means(sums, counts, nslots, ZFILL)
+  for ih in np.flatnonzero(nslots):
+    it = imonth*24 + ih
+    with span('remap', month=month, hour=int(ih)) as sp:
+      lst, fvalid = remap(zAVG[ih]), remap(zVAL[ih])
+      sp.add(elements=lst.size + fvalid.size)
+    with span('write', month=month, hour=int(ih)):
+      writer.write(it, {'LST': lst, 'FVALID': fvalid}, nslots[ih])
+  print(f"Processed {YM.strftime('%Y%m')} with {len(slots)} slots, written in {time.time()-t0M:.1f} sec")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('resol', choices=list(IFS_REFERENCES) + list(ICON_EXPERIMENTS))
+  parser.add_argument('months', nargs='+', help='YYYYMM or YYYYMM-YYYYMM')
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--chunksize', type=int, default=24, help='timesteps read at once')
+  parser.add_argument('--inflight', type=int, default=2, help='months processed concurrently, each holds one (24, cells) sum and count array in the main process')
+  parser.add_argument('--out', default=None, help='*.zarr (default) or *.nc')
+  parser.add_argument('--trace', default=None, help='trace file, *.jsonl for JSON lines, else Chrome trace')
+  args = parser.parse_args()
+  if args.trace:
+    tracing.configure(args.trace)
+
+  t0 = time.time()
+  months = parse_months(args.months)
+  fout = args.out or f"{DFOUT}/{args.resol}_LST_{months[0].strftime('%Y%m')}-{months[-1].strftime('%Y%m')}.zarr"
+
+  ## Define output regular grid
+  lon_reg, lat_reg = np.meshgrid(np.arange(-80,80.05,0.05), np.arange(80,-80.05,-0.05))
+
+  with span('setup', resol=args.resol):
+    opener, clear_sky, freq, model_time, region = setup_model(args.resol)
+    remap = NearestRemap.cached(region.points, lon_reg, lat_reg, region.grid_id, DREMAP)
+  print(f"setup of {args.resol} done in {time.time()-t0:.1f} sec")
+
+  ## one writer for all months, chunks are compressed in a thread pool
+  writer = open_writer(fout, lat_reg, lon_reg, months, workers=args.workers)
+  print(f"Saving to:{fout}")
+
+  ## at most `inflight` months are accumulated at the same time
+  pending = deque()
+  with open_pool(opener, region, clear_sky, args.workers) as pool:
+    for imonth, YM in enumerate(months):
+      slots = month_slots(YM, freq)
+      itimes = time_indices(model_time, slots)
+      pending.append((imonth, YM, slots, submit_sums(pool, itimes, slots.hour.values, args.workers, args.chunksize)))
+      if len(pending) >= args.inflight:
+        write_month(writer, *pending.popleft(), remap)
+    while pending:
+      write_month(writer, *pending.popleft(), remap)
+  writer.close()
+
+  print(f"finished in {time.time()-t0:.1f} sec")
+
+
+if __name__ == "__main__":
+  main()
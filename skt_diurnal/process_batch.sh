@@ -18,24 +18,34 @@ cd $WDIR
 mkdir -p subs 
 cd subs 
 
+## one job per year: process_batch.py runs all months of the year with one worker pool
+## the old one job per month loop is kept below for reference
+# for yr in {2020..2027}
+# do 
+# for mm in 04 05 06 07 08
+# do
+# ddate=${yr}${mm}
+
 for yr in {2020..2027}
 do 
-for mm in 04 05 06 07 08
-do
-ddate=${yr}${mm}
+ddate=${yr}04-${yr}08
 
 tag=${resol}_${ddate}
 
+## memory: the main process holds 24 x cells x 6 bytes of sums and counts per month in flight
+## (--inflight), every worker the same plus the chunk of timesteps it reads (see accumulate in diurnal_cycle.py)
+
 cat > sub_$tag << EOF
 #!/bin/bash
 #SBATCH --job-name=$tag
 #SBATCH -p shared
 #SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=5
 #SBATCH --nodes=1
 #SBATCH --time=12:00:00
 #SBATCH -o sub_${tag}.out
 #SBATCH -e sub_${tag}.err
-#SBATCH --mem=3Gb 
+#SBATCH --mem=12Gb 
 # #SBATCH --reservation=nextGEMS
 #SBATCH -A bb1153
 
@@ -43,10 +53,10 @@ module load python3
 
 cd /home/b/b381666/nextgems/skt_process
 # python3 -u process_ifs_skt.py ${resol} ${ddate}
-python3 -u process_icon_skt.py ${resol} ${ddate}
+# python3 -u process_icon_skt.py ${resol} ${ddate}
+python3 -u process_batch.py ${resol} ${ddate} --workers 4
 EOF
 
 sbatch sub_$tag
 # exit
 done 
-done 
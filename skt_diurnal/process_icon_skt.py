@@ -13,106 +13,24 @@ import sys
 import intake
 from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
 import datetime as dt 
-
-def load_var(exp,cvar=None,realm='atm',frequency='30minute',load_LALO=False):
-  ## Load catalog 
-  t0=time.time()
-  if exp == 'ngc2009':
-    catalog_file = "/home/k/k203123/NextGEMS_Cycle2.git/experiments/ngc2009/scripts/ngc2009.json"
-    grid_path = "/pool/data/ICON/grids/public/mpim/0015/icon_grid_0015_R02B09_G.nc"
-  elif exp == 'ngc2012':
-    catalog_file = "/home/k/k203123/NextGEMS_Cycle2.git/experiments/ngc2012/scripts/ngc2012.json"
-    grid_path = "/pool/data/ICON/grids/public/mpim/0033/icon_grid_0033_R02B08_G.nc"
-    frequency='3hour'
-  
-  if load_LALO:
-    grid = xr.open_dataset(grid_path)
-    model_lon = grid.clon.values*180./np.pi
-    model_lat = grid.clat.values*180./np.pi
-    return model_lat,model_lon
-    
-  cat = intake.open_esm_datastore(catalog_file)
-  final_query = cat.search(realm=realm, frequency=frequency, variable_id=cvar)
-  dataset_dict = final_query.to_dataset_dict(
-      cdf_kwargs={
-          "chunks": dict(
-              time=1,
-          )
-      }
-  )
-  keys = list(dataset_dict.keys())
-  print(keys)
-  data = dataset_dict[keys[0]]
-  print(f"Loaded {exp} {cvar} in {time.time()-t0:.1f} sec") 
- 
-  return data
+from remap import NearestRemap
+from diurnal_cycle import load_var, icon_region
+from lst_output import open_writer
+from tracing import span
 
 def inter2D(xIN):
-  nn_interpolation = NearestNDInterpolator(points_ifs, xIN)
-  return nn_interpolation(lon_reg, lat_reg)
-
-def gen_output(fout):
-   # create output file 
-  if os.path.isfile(fout):
-    os.remove(fout)
-  nc = Dataset(fout,'w',format='NETCDF4')
-
-  # create dimensions 
-  nc.createDimension('lat',len(lat_reg))
-  nc.createDimension('lon',len(lon_reg))
-  nc.createDimension('time',24)
-  
-   
-  # create dimensions variables 
-  cvar = nc.createVariable('lat','f4',['lat',])
-  cvar.units = "degrees_north"
-  cvar.long_name = "latitude"
-  cvar.standard_name = "latitude"
-  cvar.axis= "Y" 
-  cvar[:] = lat_reg[:,0]
-  
-  cvar = nc.createVariable('lon','f4',['lon',])
-  cvar.units = "degrees_east"
-  cvar.long_name = "longitude"
-  cvar.standard_name = "longitude"
-  cvar.axis= "X" 
-  cvar[:] = lon_reg[0,:]
-  
-  cvar = nc.createVariable('time','i4',['time',])
-  cvar.units = f"hours since {YM.strftime('%Y-%m-%d')}T00:00:00"
-  cvar.long_name = "time"
-  cvar.standard_name = "time"
-  cvar.axis= "T"
-  cvar.calendar = "standard"
-  cvar[:] = np.arange(24)
-   
-  
-  cvar = nc.createVariable('LST','f4',('time','lat','lon'),
-                           fill_value=ZFILL,zlib=True,complevel=6,
-                           least_significant_digit=2)
-  cvar.long_name='LST'
-  cvar.units='Celsius'
-    
-  cvar = nc.createVariable('FVALID','f4',('time','lat','lon'),
-                           fill_value=ZFILL,zlib=True,complevel=6,
-                           least_significant_digit=3)
-  cvar.long_name='fraction of valid pixels in average'
-  cvar.units='0-1'
-    
-  cvar = nc.createVariable('NSLOT','f4',('time',))
-  cvar.long_name='total number of slots processed'
-  cvar.units='-'
-    
-  return nc
+  return remap(xIN)
 
 t0 = time.time()
 resol=sys.argv[1] # 'ngc2009'
 ddate=sys.argv[2]
+outfmt = sys.argv[3] if len(sys.argv) > 3 else 'nc'   # nc or zarr
 
 #resol='ngc2009'
 #ddate="202006"
 
 DFOUT="/scratch/b/b381666/SKT_DIAG/"
+DREMAP="/scratch/b/b381666/SKT_DIAG/remap/"
 ZFILL=-999
 tcw_min = 0.005
 
@@ -126,9 +44,9 @@ YM = dt.datetime.strptime(ddate,"%Y%m")
 lon_reg, lat_reg = np.meshgrid(np.arange(-80,80.05,0.05), np.arange(80,-80.05,-0.05))
 
 ## define output file 
-fout = f"{DFOUT}/NETCDF4_{resol}_LST_{ddate}.nc"
-ncOUT = gen_output(fout)
-ncOUT.close()
+## one writer for the whole run, chunks are compressed in a thread pool
+fout = f"{DFOUT}/NETCDF4_{resol}_LST_{ddate}.nc" if outfmt == 'nc' else f"{DFOUT}/{resol}_LST_{ddate}.zarr"
+writer = open_writer(fout, lat_reg, lon_reg, [YM])
 print(f"Saving to:{fout}")
 
 ## Define output regular grid 
@@ -137,20 +55,26 @@ lon_reg, lat_reg = np.meshgrid(np.arange(-80,80.05,0.05), np.arange(80,-80.05,-0
 
 ## Load icon data 
 t0_ = time.time()
-D_ts = load_var(resol,'ts')
-D_cllvi = load_var(resol,'cllvi')
-D_clivi = load_var(resol,'clivi')
+with span('open_data'):
+  D_ts = load_var(resol,'ts')
+  D_cllvi = load_var(resol,'cllvi')
+  D_clivi = load_var(resol,'clivi')
 print(f"loaded data in {time.time()-t0_:.1f} sec") 
 
 
-## load lat/lon 
-model_lat, model_lon = load_var(resol,load_LALO=True)
+## Select region of interest, cell ranges and coordinates are cached per grid
+t0_ = time.time()
+with span('region') as sp:
+  region = icon_region(resol, DREMAP)
+  sp.add(elements=len(region))
+npp = len(region)
+print(f"region of {npp} cells in {len(region.spans)} ranges ready in {time.time()-t0_:.1f} sec") 
 
-## Select region of interest 
-reg = ( (model_lat>-81) & (model_lat<81) &
-         (model_lon >-81) & (model_lon<81) )
-npp = np.sum(reg)
-points_ifs = np.vstack((model_lon[reg], model_lat[reg])).T
+## nearest neighbour indices to the output grid, computed once per grid
+t0_ = time.time()
+with span('remap_setup', elements=lon_reg.size):
+  remap = NearestRemap.cached(region.points, lon_reg, lat_reg, region.grid_id, DREMAP)
+print(f"remap ready in {time.time()-t0_:.1f} sec") 
 
 ## Main work 
 ndays = (YM.replace(month = YM.month % 12 +1, day = 1)-dt.timedelta(days=1)).day
@@ -167,28 +91,31 @@ for ih in range(0,24,freq):
     nslotSTP = nslotSTP + 1
     print("loading",slot)
     # load data into memory 
-    skt = D_ts['ts'].sel(time=slot)[reg]  - 273.16
-    tcw = D_cllvi['cllvi'].sel(time=slot)[reg]  +  D_clivi['clivi'].sel(time=slot)[reg]
+    with span('read', hour=ih, day=iday) as sp:
+      skt = region(region.select(D_ts['ts'].sel(time=slot)))  - 273.16
+      tcw = region(region.select(D_cllvi['cllvi'].sel(time=slot)))  +  region(region.select(D_clivi['clivi'].sel(time=slot)))
+      sp.add(bytes_read=3*skt.nbytes, elements=3*skt.size)
     
     # select only clear sky 
-    xOK = tcw <= tcw_min
-    zVAL[xOK] = zVAL[xOK] + 1 
-    zAVG[xOK] = zAVG[xOK] + skt[xOK]
+    with span('accumulate', hour=ih, day=iday) as sp:
+      xOK = tcw <= tcw_min
+      zVAL[xOK] = zVAL[xOK] + 1 
+      zAVG[xOK] = zAVG[xOK] + skt[xOK]
+      sp.add(elements=skt.size)
     
   #compute averages 
   zAVG = np.where(zVAL>0,zAVG / zVAL,ZFILL)
   zVAL = np.where(zVAL>0,zVAL/nslotSTP,0)
   
-  # write to output 
-  ncOUT =  Dataset(fout,'a',format='NETCDF4')
-  ncOUT.variables['time'][ih] = ih
-  ncOUT.variables['NSLOT'][ih] = nslotSTP
-    
-  ncOUT.variables['LST'][ih,:,:] = inter2D(zAVG)
-  ncOUT.variables['FVALID'][ih,:,:] = inter2D(zVAL)
+  with span('remap', hour=ih) as sp:
+    lst, fvalid = inter2D(zAVG), inter2D(zVAL)
+    sp.add(elements=lst.size + fvalid.size)
+  # write to output, compressed while the next hour is read
+  with span('write', hour=ih):
+    writer.write(ih, {'LST': lst, 'FVALID': fvalid}, nslotSTP)
   
   print(f"Processed {ddate} hour {ih} with {nslotSTP} slots in {time.time()-t0H:.1f} sec") 
- 
-  ncOUT.close()
+
+writer.close()
 
 print(f"finished in {time.time()-t0:.1f} sec") 
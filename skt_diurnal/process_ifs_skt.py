@@ -17,63 +17,16 @@ import cmocean.cm as cmo
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
-
-def gen_output(fout):
-   # create output file 
-  if os.path.isfile(fout):
-    os.remove(fout)
-  nc = Dataset(fout,'w',format='NETCDF4')
-
-  # create dimensions 
-  nc.createDimension('lat',len(lat_reg))
-  nc.createDimension('lon',len(lon_reg))
-  nc.createDimension('time',24)
-  
-   
-  # create dimensions variables 
-  cvar = nc.createVariable('lat','f4',['lat',])
-  cvar.units = "degrees_north"
-  cvar.long_name = "latitude"
-  cvar.standard_name = "latitude"
-  cvar.axis= "Y" 
-  cvar[:] = lat_reg[:,0]
-  
-  cvar = nc.createVariable('lon','f4',['lon',])
-  cvar.units = "degrees_east"
-  cvar.long_name = "longitude"
-  cvar.standard_name = "longitude"
-  cvar.axis= "X" 
-  cvar[:] = lon_reg[0,:]
-  
-  cvar = nc.createVariable('time','i4',['time',])
-  cvar.units = f"hours since {YM.strftime('%Y-%m-%d')}T00:00:00"
-  cvar.long_name = "time"
-  cvar.standard_name = "time"
-  cvar.axis= "T"
-  cvar.calendar = "standard"
-   
-  
-  cvar = nc.createVariable('LST','f4',('time','lat','lon'),
-                           fill_value=ZFILL,zlib=True,complevel=6,
-                           least_significant_digit=2)
-  cvar.long_name='LST'
-  cvar.units='Celsius'
-    
-  cvar = nc.createVariable('FVALID','f4',('time','lat','lon'),
-                           fill_value=ZFILL,zlib=True,complevel=6,
-                           least_significant_digit=3)
-  cvar.long_name='fraction of valid pixels in average'
-  cvar.units='0-1'
-    
-  cvar = nc.createVariable('NSLOT','f4',('time',))
-  cvar.long_name='total number of slots processed'
-  cvar.units='-'
-    
-  return nc
+import functools
+from remap import NearestRemap
+from region import RegionSubset
+from diurnal_cycle import (IFS_REFERENCES, BBOX, open_reference, ifs_LALO, clear_sky_ifs, month_slots,
+                           time_indices, diurnal_sums, diurnal_means)
+from lst_output import open_writer
+from tracing import span
 
 def inter2D(xIN):
-  nn_interpolation = NearestNDInterpolator(points_ifs, xIN)
-  return nn_interpolation(lon_reg, lat_reg)
+  return remap(xIN)
 
 #resol='tco2559-ng5'  # or tco3999-ng5
 #resol='tco3999-ng5'  # or tco3999-ng5
@@ -84,8 +37,11 @@ def inter2D(xIN):
 t0 = time.time()
 resol=sys.argv[1]
 ddate=sys.argv[2]
+nworkers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+outfmt = sys.argv[4] if len(sys.argv) > 4 else 'nc'   # nc or zarr
 
 DFOUT="/scratch/b/b381666/SKT_DIAG/"
+DREMAP="/scratch/b/b381666/SKT_DIAG/remap/"
 ZFILL=-999
 tcc_min = 0.3
 
@@ -95,71 +51,57 @@ YM = dt.datetime.strptime(ddate,"%Y%m")
 lon_reg, lat_reg = np.meshgrid(np.arange(-80,80.05,0.05), np.arange(80,-80.05,-0.05))
 
 ## define output file 
-fout = f"{DFOUT}/NETCDF4_{resol}_LST_{ddate}.nc"
-ncOUT = gen_output(fout)
-ncOUT.close()
+## one writer for the whole run, chunks are compressed in a thread pool
+fout = f"{DFOUT}/NETCDF4_{resol}_LST_{ddate}.nc" if outfmt == 'nc' else f"{DFOUT}/{resol}_LST_{ddate}.zarr"
+writer = open_writer(fout, lat_reg, lon_reg, [YM], workers=nworkers)
 print(f"Saving to:{fout}")
 
 
 ## Load surface data with open_zarr() 
 # json file was already prepared with gribscan-index and gribscan-build command line tools
 t0_ = time.time()
-if resol == 'tco1279-orca025':
-  datazarr = "/work/bm1235/a270046/cycle2-sync/tco1279-orca025/nemo_deep/ICMGGc2/json.dir/atm2d_v0.json" 
-elif resol ==   'tco3999-ng5':
-  datazarr='/work/bm1235/a270046/cycle2-sync/tco3999-ng5/ICMGGc2/json.dir/atm2d.json' 
-elif resol == 'tco2559-ng5':
-  datazarr = '/work/bm1235/a270046/cycle2-sync/tco2559-ng5/ICMGGall_update/json.dir/atm2d.json'
+datazarr = IFS_REFERENCES[resol]
 print("Loading: ",datazarr)
-data = xr.open_zarr("reference::"+datazarr, consolidated=False)
+with span('open_data', reference=datazarr):
+  data = xr.open_zarr("reference::"+datazarr, consolidated=False)
 print(f"loaded data list {datazarr} in {time.time()-t0_:.1f} sec") 
 
 
-## Get the grid 
-model_lon = np.where(data.lon.values>180, data.lon.values-360, data.lon.values)
-model_lat = data.lat.values
+## Select region of interest, cell ranges and coordinates are cached per grid
+with span('region') as sp:
+  region = RegionSubset.cached(functools.partial(ifs_LALO, data), BBOX, resol, DREMAP)
+  sp.add(elements=len(region))
+npp = len(region)
 
-## Select region of interest 
-reg = ( (model_lat>-81) & (model_lat<81) &
-         (model_lon >-81) & (model_lon<81) )
-npp = np.sum(reg)
-points_ifs = np.vstack((model_lon[reg], model_lat[reg])).T
+## nearest neighbour indices to the output grid, computed once per grid
+t0_ = time.time()
+with span('remap_setup', elements=lon_reg.size):
+  remap = NearestRemap.cached(region.points, lon_reg, lat_reg, resol, DREMAP)
+print(f"remap ready in {time.time()-t0_:.1f} sec") 
 
 ## Main work 
-ndays = (YM.replace(month = YM.month % 12 +1, day = 1)-dt.timedelta(days=1)).day
-## Main loop on hours for diurnal cycle 
+## single pass over the month, all hours of the day are accumulated together
+t0_ = time.time()
+slots = month_slots(YM)
+itimes = time_indices(data.time.values, slots)
+with span('diurnal_sums', slots=len(slots), workers=nworkers):
+  sums, counts, nslots = diurnal_sums(functools.partial(open_reference, datazarr, ('skt', 'tcc')),
+                                      region, itimes, slots.hour.values,
+                                      functools.partial(clear_sky_ifs, tcc_min=tcc_min),
+                                      workers=nworkers)
+zAVG, zVAL = diurnal_means(sums, counts, nslots, ZFILL)
+print(f"Processed {ddate} with {len(slots)} slots in {time.time()-t0_:.1f} sec") 
+
 for ih in range(24):
   t0H = time.time()
-  nslotSTP = 0
-  zAVG = np.zeros(npp,'f4')
-  zVAL = np.zeros(npp,'i4')
-  # loop on days of month 
-  for iday in range(ndays):
-    slot = YM+dt.timedelta(days=iday)+dt.timedelta(hours=ih)
-    nslotSTP = nslotSTP + 1
-    print("loading",slot)
-    # load data into memory 
-    skt = data.skt.sel(time=slot)[reg] - 273.16
-    tcc = data.tcc.sel(time=slot)[reg]
-    
-    # select only clear sky 
-    xOK = tcc <= tcc_min
-    zVAL[xOK] = zVAL[xOK] + 1 
-    zAVG[xOK] = zAVG[xOK] + skt[xOK]
-    
-  #compute averages 
-  zAVG = np.where(zVAL>0,zAVG / zVAL,ZFILL)
-  zVAL = np.where(zVAL>0,zVAL/nslotSTP,0)
-  
-  # write to output 
-  ncOUT =  Dataset(fout,'a',format='NETCDF4')
-  ncOUT.variables['time'][ih] = ih
-  ncOUT.variables['NSLOT'][ih] = nslotSTP
-    
-  ncOUT.variables['LST'][ih,:,:] = inter2D(zAVG)
-  ncOUT.variables['FVALID'][ih,:,:] = inter2D(zVAL)
+  with span('remap', hour=ih) as sp:
+    lst, fvalid = inter2D(zAVG[ih]), inter2D(zVAL[ih])
+    sp.add(elements=lst.size + fvalid.size)
+  # write to output, compressed while the next hour is remapped
+  with span('write', hour=ih):
+    writer.write(ih, {'LST': lst, 'FVALID': fvalid}, nslots[ih])
   
-  print(f"Processed {ddate} hour {ih} with {nslotSTP} slots in {time.time()-t0H:.1f} sec") 
+  print(f"Saved {ddate} hour {ih} in {time.time()-t0H:.1f} sec") 
  
-  ncOUT.close()
-print(f"finished in {time.time()-t0:.1f} sec") 
+writer.close()
+print(f"finished in {time.time()-t0:.1f} sec")
@@ -0,0 +1,86 @@
+## Subset of model grid cells inside a lat/lon box
+## The cells are read as a few contiguous cell ranges instead of a boolean mask
+## over the full field, so only the chunks that intersect the region are touched.
+## The cell index and coordinates of a region are cached on disk per grid.
+
+import os
+import numpy as np
+import xarray as xr
+
+
+class RegionSubset:
+
+  def __init__(self, index, lon=None, lat=None, maxspans=64):
+    ## index: sorted cell indices of the region, lon/lat: their coordinates
+    self.index = np.asarray(index)
+    self.lon = lon
+    self.lat = lat
+    self.grid_id = None
+    self.spans = cell_spans(self.index, maxspans)
+    starts = np.array([a for a, b in self.spans])
+    offsets = np.cumsum([0] + [b - a for a, b in self.spans])
+    k = np.searchsorted(starts, self.index, 'right') - 1
+    ## position of the region cells in the concatenated spans
+    self.local = offsets[k] + self.index - starts[k]
+
+  @classmethod
+  def from_mask(cls, mask, model_lon=None, model_lat=None, maxspans=64):
+    index = np.flatnonzero(mask)
+    lon = None if model_lon is None else model_lon[index]
+    lat = None if model_lat is None else model_lat[index]
+    return cls(index, lon, lat, maxspans)
+
+  @classmethod
+  def cached(cls, load_LALO, bbox, grid_id, cachedir, maxspans=64):
+    ## region of the box (lat_min, lat_max, lon_min, lon_max) on grid_id,
+    ## load_LALO() -> (model_lat, model_lon) is only called if it is not cached yet
+    fname = os.path.join(cachedir, "region_{}_{}.npz".format(grid_id, "_".join(f"{b:g}" for b in bbox)))
+    if os.path.isfile(fname):
+      cache = np.load(fname)
+      region = cls(cache['index'], cache['lon'], cache['lat'], maxspans)
+      region.grid_id = grid_id
+      return region
+    model_lat, model_lon = load_LALO()
+    lat_min, lat_max, lon_min, lon_max = bbox
+    reg = ( (model_lat>lat_min) & (model_lat<lat_max) &
+             (model_lon >lon_min) & (model_lon<lon_max) )
+    region = cls.from_mask(reg, model_lon, model_lat, maxspans)
+    region.grid_id = grid_id
+    os.makedirs(cachedir, exist_ok=True)
+    with open(fname + ".tmp", 'wb') as f:
+      np.savez(f, index=region.index, lon=region.lon, lat=region.lat)
+    os.replace(fname + ".tmp", fname)
+    return region
+
+  def __len__(self):
+    return len(self.index)
+
+  @property
+  def points(self):
+    return np.vstack((self.lon, self.lat)).T
+
+  def select(self, field):
+    ## lazy selection of the spans along the last (cell) dimension of a DataArray
+    dim = field.dims[-1]
+    if len(self.spans) == 1:
+      a, b = self.spans[0]
+      return field.isel({dim: slice(a, b)})
+    return xr.concat([field.isel({dim: slice(a, b)}) for a, b in self.spans], dim)
+
+  def __call__(self, values):
+    ## region cells of values returned by select, same as field[..., index]
+    return np.asarray(values)[..., self.local]
+
+
+def cell_spans(index, maxspans=64):
+  ## contiguous (start, stop) ranges covering the sorted index, the smallest gaps
+  ## are bridged until at most maxspans ranges are left
+  if len(index) == 0:
+    return [(0, 0)]
+  gaps = np.diff(index) - 1
+  breaks = np.flatnonzero(gaps > 0)
+  if len(breaks) >= maxspans:
+    breaks = np.sort(breaks[np.argsort(gaps[breaks], kind='stable')[len(breaks) - maxspans + 1:]])
+  starts = np.concatenate([[index[0]], index[breaks + 1]])
+  stops = np.concatenate([index[breaks] + 1, [index[-1] + 1]])
+  return list(zip(starts.tolist(), stops.tolist()))
@@ -0,0 +1,42 @@
+## Nearest neighbour remapping from the model grid to the regular output grid
+## Source indices are computed once per (model grid, region, target grid) and
+## cached on disk, remapping a field is then a plain gather.
+
+import os
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class NearestRemap:
+  ## equivalent to NearestNDInterpolator(points, values)(lon_reg, lat_reg)
+
+  def __init__(self, index):
+    self.index = index
+
+  @classmethod
+  def build(cls, points, lon_reg, lat_reg):
+    tree = cKDTree(points)
+    _, index = tree.query(np.stack([lon_reg.ravel(), lat_reg.ravel()], axis=-1), workers=-1)
+    return cls(index.astype('i4').reshape(lon_reg.shape))
+
+  @classmethod
+  def cached(cls, points, lon_reg, lat_reg, grid_id, cachedir):
+    ## load the remap for grid_id from cachedir, or build and store it
+    ## the file name contains a hash of the source points and the target grid,
+    ## so a changed region or output grid never picks up stale indices
+    h = hashlib.blake2b(digest_size=8)
+    for a in (points, lon_reg, lat_reg):
+      h.update(np.ascontiguousarray(a).tobytes())
+    fname = os.path.join(cachedir, f"nn_{grid_id}_{lon_reg.shape[0]}x{lon_reg.shape[1]}_{h.hexdigest()}.npy")
+    if os.path.isfile(fname):
+      return cls(np.load(fname))
+    remap = cls.build(points, lon_reg, lat_reg)
+    os.makedirs(cachedir, exist_ok=True)
+    with open(fname + ".tmp", 'wb') as f:
+      np.save(f, remap.index)
+    os.replace(fname + ".tmp", fname)
+    return remap
+
+  def __call__(self, values):
+    return np.asarray(values)[self.index]
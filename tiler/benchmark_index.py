@@ -0,0 +1,70 @@
+"""
+benchmark tile index generation: per-tile `render_tile` queries vs. batched block queries
+
+defaults correspond to the configuration in build_index.ipynb (R02B11, level 8, 512px tiles).
+Only a sample of blocks is computed and the runtime is extrapolated to the full level.
+Use `--synthetic` to run without access to the grid file.
+"""
+import time
+import argparse
+import numpy as np
+import xarray as xr
+
+import icon_tiler
+from lltiler.lltiler import render_tile, numTiles
+
+GRID = "/pool/data/ICON/grids/public/mpim/0037/icon_grid_0037_R02B11_G.nc"
+
+
+def synthetic_builder(npoints, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = np.rad2deg(np.arcsin(rng.uniform(-1, 1, npoints)))
+    lon = rng.uniform(-180, 180, npoints)
+    builder = icon_tiler.TileIndexBuilder(icon_tiler.ll2xyz(lat, lon))
+    builder.element_type = "cell"
+    return builder
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", default=GRID)
+    parser.add_argument("--synthetic", type=int, default=None,
+                        help="use this many random points instead of the grid file")
+    parser.add_argument("--level", type=int, default=8)
+    parser.add_argument("--tilesize", type=int, default=512)
+    parser.add_argument("--blocksize", type=int, default=4)
+    parser.add_argument("--nblocks", type=int, default=4, help="number of blocks to sample")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    if args.synthetic:
+        builder = synthetic_builder(args.synthetic)
+    else:
+        builder = icon_tiler.CellTileIndexBuilder(xr.open_dataset(args.grid))
+    print(f"built tree in {time.time() - t0:.1f} sec")
+
+    blocks = list(icon_tiler.tile_blocks(args.level, args.blocksize))
+    sample = [blocks[i] for i in np.linspace(0, len(blocks) - 1, min(args.nblocks, len(blocks))).astype(int)]
+    ntiles = sum((tx.stop - tx.start) * (ty.stop - ty.start) for tx, ty in sample)
+    total = numTiles(args.level) ** 2
+
+    t0 = time.time()
+    for tx, ty in sample:
+        for i in range(tx.start, tx.stop):
+            for j in range(ty.start, ty.stop):
+                render_tile(i, j, args.level, builder.ll2index, args.tilesize)
+    per_tile = (time.time() - t0) / ntiles
+
+    t0 = time.time()
+    for tx, ty in sample:
+        builder.index_block(tx, ty, args.level, args.tilesize)
+    batched = (time.time() - t0) / ntiles
+
+    print(f"level {args.level}, {args.tilesize}px, {total} tiles, sampled {ntiles}")
+    print(f"per tile: {1 / per_tile:8.2f} tiles/s, estimated {per_tile * total:8.1f} sec for full level")
+    print(f"batched:  {1 / batched:8.2f} tiles/s, estimated {batched * total:8.1f} sec for full level")
+    print(f"speedup:  {per_tile / batched:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+load benchmark of the on-demand tile server
+
+Starts a tile server on a synthetic raw tile pyramid (or uses `--url` of a running server)
+and requests tiles from several client threads. Requests are skewed towards a small set of
+hot tiles on the coarser levels to mimic interactive map use.
+"""
+import time
+import tempfile
+import argparse
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import xarray as xr
+
+import icon_tiler
+import tile_server
+
+
+def synthetic_pyramid(root, var, timestr, level, tilesize):
+    n = 2 ** level
+    y = np.linspace(-1, 1, n * tilesize)
+    field = (285 + 20 * np.sin(4 * y)[:, np.newaxis] * np.cos(4 * y)[np.newaxis, :]).astype("f4")
+    tiles = (xr.DataArray(field.reshape(n, tilesize, n, tilesize).transpose(2, 0, 1, 3), dims=("tx", "ty", "y", "x"))
+             .chunk({"tx": 4, "ty": 4}))
+    icon_tiler.store_raw_tiles(tiles, f"{root}/{var}/{timestr}")
+
+
+def client(url, requests, latencies, errors, seed, maxlevel, hot):
+    rng = np.random.default_rng(seed)
+    for _ in range(requests):
+        z = int(rng.integers(0, maxlevel + 1))
+        n = 2 ** z
+        if rng.random() < hot:
+            x, y = (int(v) for v in rng.integers(0, min(n, 4), 2))
+        else:
+            x, y = (int(v) for v in rng.integers(0, n, 2))
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"{url}/{z}/{x}/{y}.png") as response:
+                response.read()
+        except urllib.error.HTTPError:
+            errors.append(1)
+        latencies.append(time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="base url of a running server, e.g. http://localhost:8000/tas/2004-04-06T00:00:00")
+    parser.add_argument("--level", type=int, default=5)
+    parser.add_argument("--tilesize", type=int, default=256)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500, help="requests per client")
+    parser.add_argument("--hot", type=float, default=0.8, help="fraction of requests to hot tiles")
+    parser.add_argument("--cache-mb", type=float, default=64)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        root = tempfile.mkdtemp()
+        synthetic_pyramid(root, "tas", "2004-04-06T00:00:00", args.level, args.tilesize)
+        service = tile_server.TileService([tile_server.PyramidSource(root)],
+                                          tile_server.TileCache(int(args.cache_mb * 2**20)))
+        server = tile_server.make_server(service, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://localhost:{server.server_port}/tas/2004-04-06T00:00:00"
+
+    latencies, errors = [], []
+    clients = [threading.Thread(target=client, args=(url, args.requests, latencies, errors, i, args.level, args.hot))
+               for i in range(args.clients)]
+    t0 = time.perf_counter()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    dt = time.perf_counter() - t0
+
+    latencies = np.array(latencies) * 1000
+    print(f"{len(latencies)} requests from {args.clients} clients in {dt:.1f} sec: {len(latencies) / dt:.1f} requests/s")
+    print(f"latency p50 {np.percentile(latencies, 50):.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms, "
+          f"p99 {np.percentile(latencies, 99):.1f} ms, {len(errors)} errors")
+    if server is not None:
+        cache = server.service.cache
+        print(f"cache hit rate {cache.hits / max(cache.hits + cache.misses, 1):.1%}, {cache.nbytes / 2**20:.1f} MB cached")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
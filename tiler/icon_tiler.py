@@ -1,11 +1,19 @@
 import os
+import io
+import json
+import time
+import hashlib
 import tqdm
 import numpy as np
 import xarray as xr
+import dask.array as da
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from scipy.spatial import KDTree
 from PIL import Image
 
-from lltiler.lltiler import resolution2zoom, render_tile, numTiles
+from lltiler.lltiler import resolution2zoom, render_tile, numTiles, xy2latlon
+
+from tracing import span
 
 
 def ll2xyz(lat, lon):
@@ -14,6 +22,54 @@ def ll2xyz(lat, lon):
     return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
 
 
+def tile_block_latlon(tx, ty, level, tilesize):
+    """
+    pixel center lat / lon of a block of tiles
+
+    :param tx: slice of tile x indices
+    :param ty: slice of tile y indices
+    :returns: lat, lon arrays with dims (tx, ty, y, x), pixels are laid out like in `render_tile`
+    """
+    pix = (np.arange(tilesize) + .5) / tilesize
+    xs = np.arange(tx.start, tx.stop)[:, np.newaxis, np.newaxis, np.newaxis] + pix[np.newaxis, np.newaxis, np.newaxis, :]
+    ys = np.arange(ty.start, ty.stop)[np.newaxis, :, np.newaxis, np.newaxis] + pix[np.newaxis, np.newaxis, :, np.newaxis]
+    return xy2latlon(*np.broadcast_arrays(xs, ys), level)
+
+
+def quadrants(a):
+    """
+    rearranges the 2x2 tiles (tx, ty, y, x, ...) covering one tile of the next coarser level
+    to (y, x, 4, ...) holding the four finer pixels around each coarser pixel center
+    in order (y, x) = (0, 0), (0, 1), (1, 0), (1, 1)
+    """
+    _, _, ny, nx = a.shape[:4]
+    rest = a.shape[4:]
+    a = a.reshape((2, 2, ny // 2, 2, nx // 2, 2) + rest)  # sx, sy, qy, dy, qx, dx
+    a = np.moveaxis(a, (1, 2, 0, 4, 3, 5), (0, 1, 2, 3, 4, 5))  # sy, qy, sx, qx, dy, dx
+    return a.reshape((ny, nx, 4) + rest)
+
+
+def in_cone(a, b, c, p):
+    """
+    checks if p lies within the cone spanned by the vectors a, b and c
+    """
+    def det(u, v, w):
+        return np.einsum("...i,...i->...", np.cross(u, v), w)
+    s = np.sign(det(a, b, c))
+    return (det(a, b, p) * s >= 0) & (det(b, c, p) * s >= 0) & (det(c, a, p) * s >= 0)
+
+
+def split_blocks(tx, ty, blocksize):
+    for itx in range(tx.start, tx.stop, blocksize):
+        for ity in range(ty.start, ty.stop, blocksize):
+            yield slice(itx, min(itx + blocksize, tx.stop)), slice(ity, min(ity + blocksize, ty.stop))
+
+
+def tile_blocks(level, blocksize):
+    n = numTiles(level)
+    return split_blocks(slice(0, n), slice(0, n), blocksize)
+
+
 class TileIndexBuilder:
     def __init__(self, xyz_coords):
         self.tree = KDTree(xyz_coords)
@@ -23,12 +79,16 @@ class TileIndexBuilder:
         d, i = self.tree.query(xyz, workers=-1)
         return i
 
-    def generate_index(self, level, tilesize):
-        idxs = np.zeros((numTiles(level), numTiles(level), tilesize, tilesize), dtype="u4")
-        for i in tqdm.tqdm(list(range(numTiles(level)))):
-            for j in range(numTiles(level)):
-                idxs[i, j] = render_tile(i, j, level, self.ll2index, tilesize)
+    def index_block(self, tx, ty, level, tilesize):
+        """
+        nearest element indices for a block of tiles using a single tree query
+        """
+        with span("index_block", level=level) as sp:
+            idxs = self.ll2index(*tile_block_latlon(tx, ty, level, tilesize)).astype("u4")
+            sp.add(elements=idxs.size)
+        return idxs
 
+    def index_dataset(self, idxs, level, tilesize):
         return xr.Dataset({
         f"{self.element_type}_of_pixel": (("tx", "ty", "y", "x"), idxs, {
             "start_index": 0,
@@ -39,6 +99,106 @@ class TileIndexBuilder:
             "tilesize": tilesize,
         })
 
+    def generate_index(self, level, tilesize, blocksize=4):
+        idxs = np.zeros((numTiles(level), numTiles(level), tilesize, tilesize), dtype="u4")
+        for tx, ty in tqdm.tqdm(list(tile_blocks(level, blocksize))):
+            idxs[tx, ty] = self.index_block(tx, ty, level, tilesize)
+
+        return self.index_dataset(idxs, level, tilesize)
+
+    def init_index_zarr(self, level, tilesize, store, blocksize=4, attrs=None, group=None):
+        """
+        writes the metadata of an index of `level` with chunks of `blocksize` x `blocksize` tiles
+        """
+        n = numTiles(level)
+        blocksize = min(blocksize, n)
+        name = f"{self.element_type}_of_pixel"
+        template = self.index_dataset(
+            da.zeros((n, n, tilesize, tilesize), dtype="u4", chunks=(blocksize, blocksize, tilesize, tilesize)),
+            level, tilesize).assign_attrs(attrs or {})
+        template.to_zarr(store, group=group, compute=False,
+                         encoding={name: {"chunks": [blocksize, blocksize, tilesize, tilesize]}})
+        return blocksize
+
+    def write_index_block(self, block, tx, ty, store, group=None):
+        with span("write_index_block", group=group) as sp:
+            xr.Dataset({f"{self.element_type}_of_pixel": (("tx", "ty", "y", "x"), block)}) \
+              .to_zarr(store, group=group, region={"tx": tx, "ty": ty})
+            sp.add(bytes_written=block.nbytes, elements=block.size)
+
+    def generate_index_zarr(self, level, tilesize, store, blocksize=4, attrs=None, group=None):
+        """
+        computes the tile index block by block and writes it directly to a zarr store
+
+        Each block of `blocksize` x `blocksize` tiles is one zarr chunk and one tree query,
+        so the full index never has to be kept in memory.
+        """
+        blocksize = self.init_index_zarr(level, tilesize, store, blocksize, attrs, group)
+        for tx, ty in tqdm.tqdm(list(tile_blocks(level, blocksize))):
+            self.write_index_block(self.index_block(tx, ty, level, tilesize), tx, ty, store, group)
+
+        return xr.open_zarr(store, group=group)
+
+    def derive_index_block(self, fine, tx, ty, level, tilesize):
+        """
+        derives the index of a block of tiles from the index of the next finer level
+
+        :param fine: indices of the 2x2 finer tiles below each tile of the block, dims (tx, ty, y, x)
+        :returns: indices of the block and the number of pixels which had to be queried again
+
+        Each coarse pixel center is the common corner of four finer pixels.
+        Voronoi regions of unit vectors are convex cones, so if all four finer pixels
+        share the same nearest element and the coarse pixel center lies within the cone spanned
+        by them, the nearest element is unchanged. Only the remaining pixels are queried.
+        """
+        idxs = np.zeros((tx.stop - tx.start, ty.stop - ty.start, tilesize, tilesize), dtype="u4")
+        todo = np.zeros(idxs.shape, dtype=bool)
+        for i, itx in enumerate(range(tx.start, tx.stop)):
+            for j, ity in enumerate(range(ty.start, ty.stop)):
+                center = ll2xyz(*tile_block_latlon(slice(itx, itx + 1), slice(ity, ity + 1), level, tilesize))[0, 0]
+                corners = quadrants(ll2xyz(*tile_block_latlon(slice(2 * itx, 2 * itx + 2), slice(2 * ity, 2 * ity + 2),
+                                                            level + 1, tilesize)))
+                candidates = quadrants(fine[2 * i:2 * i + 2, 2 * j:2 * j + 2])
+                same = (candidates == candidates[..., :1]).all(axis=-1)
+                # quad corners in cyclic order are 0, 1, 3, 2, split into two triangles
+                inside = (in_cone(corners[..., 0, :], corners[..., 1, :], corners[..., 3, :], center)
+                          | in_cone(corners[..., 0, :], corners[..., 3, :], corners[..., 2, :], center))
+                idxs[i, j] = candidates[..., 0]
+                todo[i, j] = ~(same & inside)
+
+        if todo.any():
+            with span("requery", level=level) as sp:
+                lat, lon = tile_block_latlon(tx, ty, level, tilesize)
+                idxs[todo] = self.ll2index(lat[todo], lon[todo])
+                sp.add(elements=todo.sum())
+        return idxs, todo.sum()
+
+    def generate_multilevel_index_zarr(self, maxlevel, tilesize, store, blocksize=4, attrs=None):
+        """
+        writes indices for all levels from `maxlevel` down to 0 into groups "0" ... "`maxlevel`" of one store
+
+        Only `maxlevel` is queried completely, coarser levels are derived from the next finer one.
+        All levels use the same chunk layout of `blocksize` x `blocksize` tiles.
+        """
+        assert tilesize % 2 == 0, "tilesize must be even to derive coarser levels"
+        name = f"{self.element_type}_of_pixel"
+        print(f".. level {maxlevel}")
+        self.generate_index_zarr(maxlevel, tilesize, store, blocksize, attrs, group=str(maxlevel))
+        for level in range(maxlevel - 1, -1, -1):
+            print(f".. level {level}")
+            fine = xr.open_zarr(store, group=str(level + 1))[name]
+            levelblocksize = self.init_index_zarr(level, tilesize, store, blocksize, attrs, group=str(level))
+            queried = 0
+            for tx, ty in tqdm.tqdm(list(tile_blocks(level, levelblocksize))):
+                block, nquery = self.derive_index_block(
+                    fine.isel(tx=slice(2 * tx.start, 2 * tx.stop), ty=slice(2 * ty.start, 2 * ty.stop)).values,
+                    tx, ty, level, tilesize)
+                self.write_index_block(block, tx, ty, store, group=str(level))
+                queried += nquery
+            print(f"   queried {queried / (numTiles(level) * tilesize) ** 2:.1%} of pixels")
+
+        return {level: xr.open_zarr(store, group=str(level)) for level in range(maxlevel + 1)}
+
 
 class CellTileIndexBuilder(TileIndexBuilder):
     element_type = "cell"
@@ -65,20 +225,187 @@ def pyramid_step(tiles):
             .chunk({"tx": 4, "ty": 4, "x": len(tiles.x), "y": len(tiles.y)}))
 
 
-def store_raw_tiles(tiles, folder):
-    tileds = xr.Dataset({"tiles": tiles})
-    level = int(np.log2(tileds.dims["tx"]))
-    print("storing raw tiles")
-    while level >= 0:
+def coarsen_tiles(fine):
+    """
+    averages a block of (..., 2 * ntx, 2 * nty, y, x) tiles to the (..., ntx, nty, y, x) tiles of the next
+    coarser level, ignoring NaNs, equivalent to `pyramid_step`
+    """
+    *lead, ntx, nty, ny, nx = fine.shape
+    ntx, nty = ntx // 2, nty // 2
+    quads = fine.reshape(*lead, ntx, 2, nty, 2, ny // 2, 2, nx // 2, 2)  # tx, sx, ty, sy, qy, dy, qx, dx
+    valid = ~np.isnan(quads)
+    count = valid.sum(axis=(-3, -1))
+    total = np.where(valid, quads, 0).sum(axis=(-3, -1))
+    mean = np.where(count > 0, total / np.maximum(count, 1), np.nan).astype(fine.dtype)
+    return np.moveaxis(mean, -5, -2).reshape(*lead, ntx, nty, ny, nx)
+
+
+def init_tile_zarr(filename, level, tilesize, dtype, blocksize, attrs, time=None, timechunk=1):
+    n = numTiles(level)
+    blocksize = min(blocksize, n)
+    dims = ("tx", "ty", "y", "x")
+    shape = (n, n, tilesize, tilesize)
+    chunks = (blocksize, blocksize, tilesize, tilesize)
+    coords = {
+        "tx": np.arange(n),
+        "ty": np.arange(n),
+        "y": np.arange(tilesize),
+        "x": np.arange(tilesize),
+    }
+    if time is not None:
+        dims = ("time",) + dims
+        shape = (len(time),) + shape
+        chunks = (min(timechunk, len(time)),) + chunks
+        coords["time"] = time
+    xr.Dataset({
+        "tiles": (dims, da.zeros(shape, dtype=dtype, chunks=chunks), attrs)
+    }, coords=coords).to_zarr(filename, mode="w", compute=False, encoding={"tiles": {"chunks": list(chunks)}})
+
+
+def tile_hashes(block):
+    """
+    content hashes of each tile in a block (..., tx, ty, y, x) as nested lists (tx, ty)
+    """
+    return [[hashlib.blake2b(np.ascontiguousarray(block[..., i, j, :, :]).tobytes(), digest_size=16).hexdigest()
+             for j in range(block.shape[-3])]
+            for i in range(block.shape[-4])]
+
+
+class TileManifest:
+    """
+    append-only log of completed tile blocks and their per-tile content hashes
+
+    Every completed block is appended as one line to `filename`, so an interrupted
+    run leaves a valid manifest behind and can continue from the last completed block.
+    """
+    def __init__(self, filename, reset=False):
+        self.filename = filename
+        self.blocks = {}
+        if reset and os.path.exists(filename):
+            os.remove(filename)
+        if os.path.exists(filename):
+            with open(filename) as infile:
+                for line in infile:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:  # partially written last line
+                        continue
+                    self.blocks[entry["key"]] = entry
+            self.compact()
+
+    @staticmethod
+    def key(level, tx, ty, region=None):
+        region = "".join(f"/{k}={v.start}" for k, v in (region or {}).items())
+        return f"{level}/{tx.start}/{ty.start}{region}"
+
+    def compact(self):
+        with open(self.filename + ".tmp", "w") as outfile:
+            for entry in self.blocks.values():
+                outfile.write(json.dumps(entry) + "\n")
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def done(self, level, tx, ty, region=None):
+        return self.key(level, tx, ty, region) in self.blocks
+
+    def add(self, level, tx, ty, hashes, region=None):
+        entry = {"key": self.key(level, tx, ty, region), "level": level, "tx": tx.start, "ty": ty.start, "hashes": hashes}
+        self.blocks[entry["key"]] = entry
+        with open(self.filename, "a") as outfile:
+            outfile.write(json.dumps(entry) + "\n")
+
+    def level_hashes(self, level):
+        """
+        content hashes of all recorded tiles of `level` by (tx, ty)
+        """
+        return {(entry["tx"] + i, entry["ty"] + j): h
+                for entry in self.blocks.values() if entry["level"] == level
+                for i, row in enumerate(entry["hashes"])
+                for j, h in enumerate(row)}
+
+
+def write_pyramid(get_block, folder, maxlevel, blocksize=4, region=None, manifest=None):
+    """
+    writes the tiles returned by `get_block(tx, ty)` and all coarser levels into the pyramid in `folder`
+
+    The quad-tree is traversed depth first: every block of `blocksize` x `blocksize` tiles
+    is averaged into its parent block as soon as it has been written, so all levels are
+    written in a single pass and only one branch of the tree is kept in memory.
+
+    :param get_block: returns tiles (..., tx, ty, y, x) at `maxlevel` for slices `tx` and `ty`
+    :param region: additional zarr region of the leading dimensions, e.g. `{"time": slice(0, 24)}`
+    :param manifest: `TileManifest`, blocks recorded there are read back instead of being computed again
+    """
+    region = region or {}
+    progress = tqdm.tqdm(total=len(list(tile_blocks(maxlevel, blocksize))))
+
+    def branch(level, tx, ty):
         filename = os.path.join(folder, f"{level}.zarr")
-        print(f".. level {level}")
-        tileds.to_zarr(filename)
-        if level > 0:
-            tileds = pyramid_step(xr.open_zarr(filename, chunks={"tx": 8, "ty": 8}))
-        level = level - 1
+        if manifest is not None and manifest.done(level, tx, ty, region):
+            scale = 2 ** (maxlevel - level)
+            progress.update(len(list(split_blocks(slice(scale * tx.start, scale * tx.stop),
+                                                  slice(scale * ty.start, scale * ty.stop), blocksize))))
+            return xr.open_zarr(filename).tiles.isel(**region, tx=tx, ty=ty).values
+        if level == maxlevel:
+            with span("read_block", level=level) as sp:
+                block = get_block(tx, ty)
+                sp.add(bytes_read=block.nbytes, elements=block.size)
+            progress.update()
+        else:
+            fine = None
+            for ctx, cty in split_blocks(slice(2 * tx.start, 2 * tx.stop), slice(2 * ty.start, 2 * ty.stop), blocksize):
+                child = branch(level + 1, ctx, cty)
+                if fine is None:
+                    fine = np.empty(child.shape[:-4] + (2 * (tx.stop - tx.start), 2 * (ty.stop - ty.start)) + child.shape[-2:],
+                                    dtype=child.dtype)
+                fine[..., ctx.start - 2 * tx.start:ctx.stop - 2 * tx.start,
+                          cty.start - 2 * ty.start:cty.stop - 2 * ty.start, :, :] = child
+            with span("coarsen", level=level) as sp:
+                block = coarsen_tiles(fine)
+                sp.add(elements=fine.size)
+        dims = tuple(region) + ("tx", "ty", "y", "x")
+        with span("write_block", level=level) as sp:
+            xr.Dataset({"tiles": (dims, block)}).to_zarr(filename, region={**region, "tx": tx, "ty": ty})
+            sp.add(bytes_written=block.nbytes, elements=block.size)
+        if manifest is not None:
+            manifest.add(level, tx, ty, tile_hashes(block), region)
+        return block
+
+    branch(0, slice(0, 1), slice(0, 1))
+    progress.close()
+
+
+def open_pyramid(folder, maxlevel, resume):
+    """
+    opens the manifest of the pyramid in `folder`, a fresh pyramid is started unless
+    `resume` is set and all levels exist already
+
+    :returns: manifest and whether the zarr stores have to be initialized
+    """
+    complete = all(os.path.exists(os.path.join(folder, f"{level}.zarr")) for level in range(maxlevel + 1))
+    fresh = not (resume and complete)
+    return TileManifest(os.path.join(folder, "manifest.jsonl"), reset=fresh), fresh
 
 
-def build_raw_tiles(var, index, folder):
+def store_raw_tiles(tiles, folder, blocksize=4, resume=False):
+    """
+    stores `tiles` (tx, ty, y, x) and all coarser pyramid levels to `{level}.zarr` in `folder`
+
+    Content hashes of all tiles are recorded in `{folder}/manifest.jsonl`. With `resume`,
+    blocks completed by a previous, interrupted run are not computed again.
+    """
+    maxlevel = int(np.log2(tiles.sizes["tx"]))
+    dtype = np.result_type(tiles.dtype, np.float32)
+    print("storing raw tiles")
+    manifest, fresh = open_pyramid(folder, maxlevel, resume)
+    if fresh:
+        for level in range(maxlevel + 1):
+            init_tile_zarr(os.path.join(folder, f"{level}.zarr"), level, tiles.sizes["y"], dtype, blocksize, tiles.attrs)
+
+    write_pyramid(lambda tx, ty: tiles.isel(tx=tx, ty=ty).values.astype(dtype), folder, maxlevel, blocksize,
+                  manifest=manifest)
+
+
+def build_raw_tiles(var, index, folder, resume=False):
     values = var.values
     
     def get(x):
@@ -89,25 +416,175 @@ def build_raw_tiles(var, index, folder):
                                for name, size in zip(index.dims, index.shape)})
              .assign_attrs(var.attrs))
     
-    store_raw_tiles(tiles, folder)
+    store_raw_tiles(tiles, folder, resume=resume)
+
+
+def build_raw_tiles_timeseries(var, index, folder, timechunk=24, blocksize=1, resume=False):
+    """
+    tiles a (time, cell) variable into a time-chunked pyramid of (time, tx, ty, y, x) raw tiles
+
+    `timechunk` timesteps are loaded at once and every index block is read only once per
+    time chunk and applied to all of its timesteps with a single gather.
+    """
+    maxlevel = int(np.log2(index.sizes["tx"]))
+    dtype = np.result_type(var.dtype, np.float32)
+    print("storing raw tile time series")
+    manifest, fresh = open_pyramid(folder, maxlevel, resume)
+    if fresh:
+        for level in range(maxlevel + 1):
+            init_tile_zarr(os.path.join(folder, f"{level}.zarr"), level, index.sizes["y"], dtype, blocksize, var.attrs,
+                           time=var.time.values, timechunk=timechunk)
+
+    for t0 in range(0, var.sizes["time"], timechunk):
+        times = slice(t0, min(t0 + timechunk, var.sizes["time"]))
+        if manifest.done(0, slice(0, 1), slice(0, 1), {"time": times}):
+            continue
+        print(f".. time {times.start}:{times.stop}")
+        values = var.isel(time=times).transpose("time", "cell").values.astype(dtype)
+        write_pyramid(lambda tx, ty: values[:, index.isel(tx=tx, ty=ty).values],
+                      folder, maxlevel, blocksize, region={"time": times}, manifest=manifest)
+
 
+IMAGE_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
 
-def build_image_tiles(rawfolder, targetfolder, norm, cmap, maxlevel):
+
+def colormap_lut(cmap):
+    """
+    RGB lookup table of `cmap` with `cmap.N` colors followed by the under, over and bad colors
+    """
+    return np.concatenate([cmap(np.arange(cmap.N), bytes=True),
+                           cmap(np.array([-1, cmap.N]), bytes=True),
+                           cmap(np.array([np.nan]), bytes=True)])[:, :3]
+
+
+def quantize(values, norm, ncolors):
+    """
+    maps values to indices into a `colormap_lut` the same way as `cmap(norm(values))`
+    """
+    with np.errstate(invalid="ignore"):
+        x = np.ma.filled(norm(values), np.nan).astype("f8") * ncolors
+        x[x == ncolors] = ncolors - 1
+        q = np.where(x < 0, ncolors,
+            np.where(x >= ncolors, ncolors + 1,
+            np.where(np.isnan(x), ncolors + 2, x)))
+    return q.astype("u2")
+
+
+def encode_image(q, lut, fmt):
+    """
+    encodes a tile of color indices (y, x) as image of format `fmt`
+    """
+    buf = io.BytesIO()
+    Image.fromarray(lut[q]).save(buf, format=IMAGE_FORMATS[fmt])
+    return buf.getvalue()
+
+
+_uniform_tiles = {}
+
+
+def encode_tiles(block, tx, ty, prefix, norm, lut, fmt, todo=None):
+    """
+    colorizes and encodes a block of raw tiles (tx, ty, y, x) to `{prefix}/{tx}/{ty}.{fmt}`
+
+    Tiles without any valid value are skipped, tiles of a single color are encoded only once
+    per process and reused.
+
+    :param todo: boolean mask (tx, ty) of the tiles to encode, defaults to all tiles
+    :returns: number of written and skipped tiles
+    """
+    with span("encode_tiles", prefix=prefix) as sp:
+        written, skipped, nbytes = _encode_tiles(block, tx, ty, prefix, norm, lut, fmt, todo)
+        sp.add(elements=block.size, bytes_written=nbytes)
+    return written, skipped
+
+
+def _encode_tiles(block, tx, ty, prefix, norm, lut, fmt, todo):
+    ncolors = len(lut) - 3
+    q = quantize(block, norm, ncolors)
+    written = skipped = nbytes = 0
+    for i, itx in enumerate(range(tx.start, tx.stop)):
+        for j, ity in enumerate(range(ty.start, ty.stop)):
+            if todo is not None and not todo[i, j]:
+                continue
+            tile = q[i, j]
+            filename = os.path.join(prefix, str(itx), f"{ity}.{fmt}")
+            first = tile.flat[0]
+            uniform = (tile == first).all()
+            if uniform and first == ncolors + 2:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                skipped += 1
+                continue
+            key = (tuple(lut[first]), tile.shape, fmt)
+            if uniform and key in _uniform_tiles:
+                data = _uniform_tiles[key]
+            else:
+                data = encode_image(tile, lut, fmt)
+                if uniform:
+                    _uniform_tiles[key] = data
+            with open(filename, "wb") as outfile:
+                outfile.write(data)
+            written += 1
+            nbytes += len(data)
+    return written, skipped, nbytes
+
+
+def build_image_tiles(rawfolder, targetfolder, norm, cmap, maxlevel, fmt="jpg", workers=None):
+    """
+    colorizes the raw tile pyramid in `rawfolder` and stores image tiles to `{targetfolder}/{level}/{tx}/{ty}.{fmt}`
+
+    Colors are looked up from a precomputed table and tiles are encoded chunk by chunk in a process pool.
+    The content hash of the raw tile and the color settings used for every image tile are recorded in
+    `{targetfolder}/manifest.jsonl`, only tiles whose raw data or settings changed are encoded again.
+    This also continues interrupted runs from the last completed chunk.
+    """
     print("storing image tiles")
-    for level in range(maxlevel+1):
-        prefix = f"{targetfolder}/{level}/"
-
-        def store_images(block):
-            for itx, tx in enumerate(block.tx.values):
-                for ity, ty in enumerate(block.ty.values):
-                    name = f"{tx}/{ty}.jpg"
-                    im = Image.fromarray(cmap(norm(block.isel(tx=itx, ty=ity)), bytes=True)[..., :3])
-                    filename = os.path.join(prefix, name)
-                    os.makedirs(os.path.dirname(filename), exist_ok=True)
-                    im.save(filename)
-            return block.tx * block.ty
-
-        print(f".. level {level}")
-        ds = xr.open_zarr(os.path.join(rawfolder, f"{level}.zarr"))
-        run = xr.map_blocks(store_images, ds.tiles)
-        run.compute()
\ No newline at end of file
+    lut = colormap_lut(cmap)
+    settings = hashlib.blake2b(lut.tobytes() + repr((type(norm).__name__, norm.vmin, norm.vmax, fmt)).encode(),
+                               digest_size=8).hexdigest()
+    rawmanifest = TileManifest(os.path.join(rawfolder, "manifest.jsonl"))
+    os.makedirs(targetfolder, exist_ok=True)
+    manifest = TileManifest(os.path.join(targetfolder, "manifest.jsonl"))
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+        for level in range(maxlevel+1):
+            t0 = time.time()
+            prefix = os.path.join(targetfolder, str(level))
+            tiles = xr.open_zarr(os.path.join(rawfolder, f"{level}.zarr")).tiles
+            for tx in range(tiles.sizes["tx"]):
+                os.makedirs(os.path.join(prefix, str(tx)), exist_ok=True)
+            rawhashes = rawmanifest.level_hashes(level)
+            imagehashes = manifest.level_hashes(level)
+
+            written = skipped = unchanged = 0
+            pending = {}
+
+            def collect(futures):
+                nonlocal written, skipped
+                for future in futures:
+                    w, s = future.result()
+                    written, skipped = written + w, skipped + s
+                    manifest.add(level, *pending.pop(future))
+
+            for tx, ty in tile_blocks(level, tiles.encoding["chunks"][0]):
+                expected = [[f"{rawhashes[itx, ity]}:{settings}" if (itx, ity) in rawhashes else None
+                             for ity in range(ty.start, ty.stop)]
+                            for itx in range(tx.start, tx.stop)]
+                todo = np.array([[h is None or imagehashes.get((itx, ity)) != h
+                                  for ity, h in zip(range(ty.start, ty.stop), row)]
+                                 for itx, row in zip(range(tx.start, tx.stop), expected)])
+                unchanged += (~todo).sum()
+                if not todo.any():
+                    continue
+                if len(pending) >= 2 * workers:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                with span("read_block", level=level) as sp:
+                    block = tiles.isel(tx=tx, ty=ty).values
+                    sp.add(bytes_read=block.nbytes, elements=block.size)
+                future = pool.submit(encode_tiles, block, tx, ty, prefix, norm, lut, fmt, todo)
+                pending[future] = (tx, ty, expected)
+            collect(wait(pending).done)
+
+            dt = time.time() - t0
+            print(f".. level {level}: {written} tiles in {dt:.1f} sec ({(written + skipped) / dt:.1f} tiles/s), "
+                  f"{skipped} empty tiles skipped, {unchanged} unchanged")
@@ -0,0 +1,256 @@
+"""
+on-demand tile server
+
+serves `/{var}/{time}/{z}/{x}/{y}.png` (or .jpg / .webp) by colorizing raw tiles on request,
+either from raw tile pyramids written by `icon_tiler.store_raw_tiles` or by gathering directly
+through the `cell_of_pixel` indices of `TileIndexBuilder.generate_multilevel_index_zarr`.
+Rendered tiles are kept in a size-bounded LRU cache which optionally spills to disk.
+"""
+import os
+import re
+import hashlib
+import argparse
+import threading
+import functools
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import xarray as xr
+import matplotlib as mpl
+
+from icon_tiler import colormap_lut, quantize, encode_image
+
+STYLES = {
+    "sfcwind": (mpl.colors.Normalize(vmin=0, vmax=25), mpl.cm.RdYlBu_r),
+    "tas": (mpl.colors.Normalize(vmin=260, vmax=310), mpl.cm.turbo),
+}
+
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+
+class TileCache:
+    """
+    LRU cache of encoded tiles bounded by `maxbytes`, evicted tiles are spilled to `spill` if given
+    """
+    def __init__(self, maxbytes, spill=None):
+        self.maxbytes = maxbytes
+        self.spill = spill
+        self.nbytes = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return self.tiles[key]
+        if self.spill is not None:
+            filename = self.spill_path(key)
+            if os.path.exists(filename):
+                with open(filename, "rb") as infile:
+                    data = infile.read()
+                self.put(key, data)
+                with self.lock:
+                    self.hits += 1
+                return data
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def spill_path(self, key):
+        # spilled tiles are named by a hash of the key, so a key never reaches outside `spill`
+        return os.path.join(self.spill, hashlib.sha256(key.encode()).hexdigest())
+
+    def put(self, key, data):
+        evicted = []
+        with self.lock:
+            if key in self.tiles:
+                self.nbytes -= len(self.tiles.pop(key))
+            self.tiles[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.maxbytes and len(self.tiles) > 1:
+                oldkey, olddata = self.tiles.popitem(last=False)
+                self.nbytes -= len(olddata)
+                evicted.append((oldkey, olddata))
+        if self.spill is not None:
+            os.makedirs(self.spill, exist_ok=True)
+            for oldkey, olddata in evicted:
+                filename = self.spill_path(oldkey)
+                with open(filename, "wb") as outfile:
+                    outfile.write(olddata)
+
+
+class PyramidSource:
+    """
+    raw tiles written by `store_raw_tiles` to `{root}/{var}/{time}/{z}.zarr`, with `time` to the second
+    like 2020-01-20T00:00:00, or by `build_raw_tiles_timeseries` to `{root}/{var}/{z}.zarr`
+
+    up to `maxstores` stores are kept open, missing stores are looked for again on every request
+    so pyramids written while the server runs are served
+    """
+    def __init__(self, root, maxstores=256):
+        self.root = root
+        self.maxstores = maxstores
+        self.stores = OrderedDict()
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        with self.lock:
+            if path in self.stores:
+                self.stores.move_to_end(path)
+                return self.stores[path]
+        if not os.path.exists(path):
+            return None
+        tiles = xr.open_zarr(path).tiles
+        with self.lock:
+            self.stores[path] = tiles
+            while len(self.stores) > self.maxstores:
+                self.stores.popitem(last=False)
+        return tiles
+
+    def get(self, var, time, z, x, y):
+        tiles = self.open(os.path.join(self.root, var, time, f"{z}.zarr"))
+        if tiles is None:
+            tiles = self.open(os.path.join(self.root, var, f"{z}.zarr"))
+            if tiles is None or "time" not in tiles.dims:
+                return None
+            try:
+                tiles = tiles.sel(time=np.datetime64(time))
+            except (KeyError, ValueError):
+                return None
+        if not (0 <= x < tiles.sizes["tx"] and 0 <= y < tiles.sizes["ty"]):
+            return None
+        return tiles.isel(tx=x, ty=y).values
+
+
+class IndexSource:
+    """
+    gathers tiles of the (time, cell) variables in `data` through the per-level
+    `cell_of_pixel` indices in `index_store`
+    """
+    def __init__(self, index_store, data, fields=4):
+        self.index_store = index_store
+        self.data = data
+        self.indices = {}
+        self.lock = threading.Lock()
+        self.field = functools.lru_cache(maxsize=fields)(self.load_field)
+
+    def load_field(self, var, time):
+        return self.data[var].sel(time=np.datetime64(time)).values
+
+    def index(self, z):
+        with self.lock:
+            if z not in self.indices:
+                exists = os.path.exists(os.path.join(self.index_store, str(z)))
+                self.indices[z] = xr.open_zarr(self.index_store, group=str(z)).cell_of_pixel if exists else None
+            return self.indices[z]
+
+    def get(self, var, time, z, x, y):
+        index = self.index(z)
+        if var not in self.data or index is None:
+            return None
+        if not (0 <= x < index.sizes["tx"] and 0 <= y < index.sizes["ty"]):
+            return None
+        try:
+            field = self.field(var, time)
+        except (KeyError, ValueError):
+            return None
+        return field[index.isel(tx=x, ty=y).values]
+
+
+class TileService:
+    def __init__(self, sources, cache, styles=STYLES):
+        self.sources = sources
+        self.cache = cache
+        self.styles = styles
+        self.luts = {var: colormap_lut(cmap) for var, (norm, cmap) in styles.items()}
+
+    def tile(self, var, time, z, x, y, fmt="png"):
+        """
+        encoded tile or None if there is no such tile, tiles without valid values are returned as empty bytes
+        """
+        if var not in self.styles:
+            return None
+        try:
+            time = str(np.datetime64(time, "s"))
+        except ValueError:
+            return None
+        key = f"{var}/{time}/{z}/{x}/{y}.{fmt}"
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        for source in self.sources:
+            raw = source.get(var, time, z, x, y)
+            if raw is not None:
+                break
+        else:
+            return None
+        norm, _ = self.styles[var]
+        lut = self.luts[var]
+        q = quantize(raw, norm, len(lut) - 3)
+        data = b"" if (q == len(lut) - 1).all() else encode_image(q, lut, fmt)
+        self.cache.put(key, data)
+        return data
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    pattern = re.compile(r"^/(?P<var>[^/]+)/(?P<time>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<fmt>png|jpg|webp)$")
+
+    def do_GET(self):
+        match = self.pattern.match(urllib.parse.unquote(self.path))
+        if match is None:
+            self.send_error(404)
+            return
+        data = self.server.service.tile(match["var"], match["time"],
+                                        int(match["z"]), int(match["x"]), int(match["y"]), match["fmt"])
+        if not data:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[match["fmt"]])
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(service, host="localhost", port=8000, verbose=False):
+    server = ThreadingHTTPServer((host, port), TileRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw", action="append", default=[],
+                        help="root folder of raw tile pyramids ({root}/{var}/{time}/{z}.zarr), may be repeated")
+    parser.add_argument("--index", help="multi-level cell_of_pixel index store")
+    parser.add_argument("--data", help="dataset with (time, cell) variables to gather through --index")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-mb", type=float, default=512)
+    parser.add_argument("--spill", help="folder for tiles evicted from the memory cache")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    sources = [PyramidSource(root) for root in args.raw]
+    if args.index and args.data:
+        sources.append(IndexSource(args.index, xr.open_dataset(args.data, chunks={})))
+    service = TileService(sources, TileCache(int(args.cache_mb * 2**20), args.spill))
+    server = make_server(service, args.host, args.port, args.verbose)
+    print(f"serving tiles on http://{args.host}:{args.port}/{{var}}/{{time}}/{{z}}/{{x}}/{{y}}.png")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+lightweight tracing of processing stages
+
+A span records wall time, CPU time of the thread running it and counters such as bytes read, bytes
+written or element counts of one stage. Tracing is off unless a trace file is configured,
+then `span()` returns a shared no-op object, so instrumented code costs one global lookup.
+
+    TRACE=month.json python process_ifs_skt.py tco2559-ng5 202005    # Chrome trace, open in ui.perfetto.dev
+    TRACE=month.jsonl python process_ifs_skt.py tco2559-ng5 202005   # one JSON object per span
+
+    with span("read", variable="skt") as sp:
+        values = field.values
+        sp.add(bytes_read=values.nbytes, elements=values.size)
+
+Worker processes write their spans to their own file next to the main one (`month.<pid>.json`).
+The instrumented folders (IFS, skt_diurnal, tiler) link tracing.py, so it is importable wherever
+their modules are. CPU times are per thread, e.g. of the compression threads of lst_output.
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+import multiprocessing.util
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counts):
+        pass
+
+
+_NOSPAN = _NoSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start", "t0", "c0")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def add(self, **counts):
+        """
+        add to the counters of the span, e.g. bytes_read, bytes_written, elements
+        """
+        for key, value in counts.items():
+            self.args[key] = self.args.get(key, 0) + value
+
+    def __enter__(self):
+        self.start = time.time()
+        self.t0, self.c0 = time.perf_counter(), time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.emit(self.name, self.start, time.perf_counter() - self.t0, time.thread_time() - self.c0,
+                         self.args)
+        return False
+
+
+class Tracer:
+    def __init__(self, path):
+        """
+        :param path: *.jsonl for JSON lines, anything else for the Chrome trace event format
+        """
+        self.path = path
+        self.chrome = not path.endswith(".jsonl")
+        self.owner = os.getpid()
+        self.pid = None
+        self.file = None
+        self.first = True
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _open(self):
+        # one file per process, a forked worker must not write into the file of its parent
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        root, ext = os.path.splitext(self.path)
+        self.file = open(self.path if pid == self.owner else f"{root}.{pid}{ext}", "w")
+        if pid != self.owner:
+            # pool workers leave without running atexit handlers
+            multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+        self.pid = pid
+        self.first = True
+        if self.chrome:
+            self.file.write("[\n")
+
+    def emit(self, name, start, wall, cpu, args):
+        if self.chrome:
+            record = {"name": name, "ph": "X", "ts": start * 1e6, "dur": wall * 1e6, "pid": os.getpid(),
+                      "tid": threading.get_ident(), "args": {**args, "cpu_s": cpu}}
+        else:
+            record = {"name": name, "start": start, "wall_s": wall, "cpu_s": cpu, "pid": os.getpid(),
+                      "tid": threading.get_ident(), **args}
+        line = json.dumps(record, default=float)
+        with self.lock:
+            self._open()
+            if self.chrome and not self.first:
+                line = ",\n" + line
+            elif not self.chrome:
+                line += "\n"
+            self.first = False
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and self.pid == os.getpid():
+                if self.chrome:
+                    self.file.write("\n]\n")
+                self.file.close()
+                self.file = None
+
+
+_tracer = None
+
+
+def configure(path=None):
+    """
+    trace to `path`, or to $TRACE if not given; tracing is off if neither is set
+    """
+    global _tracer
+    path = path or os.environ.get("TRACE")
+    _tracer = Tracer(path) if path else None
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, **args):
+    """
+    context manager timing a stage, `args` are recorded with it
+    """
+    if _tracer is None:
+        return _NOSPAN
+    return Span(_tracer, name, args)
+
+
+def traced(name=None):
+    """
+    decorator running the function in a span
+    """
+    def decorate(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with Span(_tracer, label, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+configure()